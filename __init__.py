@@ -19,8 +19,15 @@ def register():
         configurator.QuotationCategory,
         configurator.QuotationSupplier,
         configurator.SupplierProductIpnr,
+        configurator.Cron,
         jinja_templates.JinjaTemplateMacros,
         jinja_templates.JinjaTemplate,
         product.Template,
         product.Product,
+        product.ProductAttribute,
+        product.ProductSupplier,
+        product.ProductSupplierPrice,
         module='product_dynamic_configurator', type_='model')
+    Pool.register(
+        configurator.RequoteDesign,
+        module='product_dynamic_configurator', type_='wizard')
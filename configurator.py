@@ -1,24 +1,36 @@
+import ast
+import datetime
+import hashlib
+import heapq
 import logging
 import math
+import sys
+import threading
 import traceback
 from ast import literal_eval
-from collections import OrderedDict
-from copy import copy
+from collections import ChainMap, OrderedDict, defaultdict
 from decimal import Decimal
+from weakref import WeakKeyDictionary
 
-from jinja2 import Template as Jinja2Template
+from jinja2 import Environment as Jinja2Environment
+from jinja2 import meta as jinja2_meta
 from jinja2.exceptions import TemplateSyntaxError
 from jinja2.exceptions import UndefinedError as Jinja2UndefinedError
-from simpleeval import simple_eval
+from simpleeval import SimpleEval
+from sql import Literal, Null, Union
+from sql.aggregate import Count, Max
+from sql.conditionals import Case
 import trytond.config as config_
+from trytond.cache import Cache
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
-from trytond.model import (DeactivableMixin, ModelSQL, ModelView, Workflow,
-                           fields, sequence_ordered, tree)
+from trytond.model import (DeactivableMixin, Index, Model, ModelSQL,
+                           ModelView, Workflow, fields, sequence_ordered, tree)
 from trytond.modules.company.model import employee_field
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Bool, Eval, If, Not
 from trytond.transaction import Transaction
+from trytond.wizard import StateTransition, Wizard
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +54,271 @@ TYPE = [
     ('attribute', 'Product Attribute'),
 ]
 
+EVAL_FUNCTIONS = {
+    'Decimal': Decimal,
+    'abs': abs,
+    'bool': bool,
+    'float': float,
+    'int': int,
+    'len': len,
+    'max': max,
+    'min': min,
+    'pow': pow,
+    'round': round,
+    'str': str,
+    'sum': sum,
+    }
+
+
+def property_sequence(prop):
+    node = prop.get_node()
+    if node:
+        return node.sort_key
+    return (str(prop.parent and prop.parent.sequence or 0).zfill(5)
+        + str(prop.sequence).zfill(6))
+
+
+class PropertyNode:
+    '''
+    Immutable snapshot of a configurator.property and its position in the
+    property tree.
+
+    The parent, BOM parent and children are stored as ids.
+    '''
+    __slots__ = ('id', 'parent', 'code', 'type', 'sequence', 'active', 'bom',
+        'full_code', 'full_path', 'sort_key', 'childs', 'childrens')
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values.get(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('PropertyNode is immutable')
+
+    def __repr__(self):
+        return '<PropertyNode %s %s>' % (self.id, self.code)
+
+    # The cache copies and may pickle the values it stores
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (self.__class__._make,
+            (tuple(getattr(self, n) for n in self.__slots__),))
+
+    @classmethod
+    def _make(cls, values):
+        return cls(**dict(zip(cls.__slots__, values)))
+
+    @classmethod
+    def build(cls, rows):
+        "Return the nodes of rows keyed by id"
+        rows = {r['id']: r for r in rows}
+        childs = defaultdict(list)
+        for row in rows.values():
+            if row['parent'] in rows:
+                childs[row['parent']].append(row)
+        for values in childs.values():
+            values.sort(key=lambda r: (r['sequence'] or 0, r['id']))
+
+        def get_bom(row):
+            while row['type'] != 'bom' and row['parent'] in rows:
+                row = rows[row['parent']]
+            return row
+
+        def get_path(row):
+            path = row['code'] if row['code'] and row['parent'] else ''
+            parent = rows.get(row['parent'])
+            while parent and parent['parent']:
+                path = '%s_%s' % (parent['code'], path)
+                parent = rows.get(parent['parent'])
+            return path
+
+        def descendants(row):
+            # As the child_of searches, the whole subtree is followed but only
+            # the active properties are returned
+            if row['active']:
+                yield row
+            for child in childs[row['id']]:
+                yield from descendants(child)
+
+        boms = {id_: get_bom(row) for id_, row in rows.items()}
+        # Properties priced under each BOM as returned by get_childrens
+        owners = {}
+        for id_, row in rows.items():
+            if row['type'] not in ('bom', 'product', 'purchase_product',
+                    'match'):
+                continue
+            if row['type'] == 'bom':
+                owner = row['parent'] in rows and boms[row['parent']]
+            else:
+                owner = boms[id_]
+            if owner:
+                owners[id_] = owner['id']
+        childrens = {}
+        for bom_id in set(boms[x]['id'] for x in rows):
+            childrens[bom_id] = tuple(r['id']
+                for r in descendants(rows[bom_id])
+                if owners.get(r['id']) == bom_id)
+
+        nodes = {}
+        for id_, row in rows.items():
+            bom = boms[id_]
+            full_code = row['code'] or ''
+            if row['code'] and bom['parent']:
+                full_code = '%s_%s' % (bom['code'], row['code'])
+            parent = rows.get(row['parent'])
+            nodes[id_] = cls(
+                id=id_,
+                parent=row['parent'],
+                code=row['code'],
+                type=row['type'],
+                sequence=row['sequence'],
+                active=row['active'],
+                bom=bom['id'],
+                full_code=full_code,
+                full_path=get_path(row),
+                sort_key=(str(parent and parent['sequence'] or 0).zfill(5)
+                    + str(row['sequence']).zfill(6)),
+                childs=tuple(r['id'] for r in childs[id_]),
+                childrens=childrens.get(bom['id'], ()),
+                )
+        return nodes
+
+
+class MatchIndex:
+    '''
+    Inverted index of the attribute values of the service products of a
+    supplier.
+
+    The products are indexed by (attribute set, attribute, value) with the id
+    of their matching attribute, so the equality criteria of the match
+    properties are resolved by intersecting them.
+    '''
+    __slots__ = ('products', 'counts', 'size', 'memory')
+    types = {
+        'boolean': (bool,),
+        'char': (str,),
+        'integer': (int, float),
+        }
+
+    def __init__(self, rows):
+        products = defaultdict(dict)
+        counts = defaultdict(int)
+        for row in rows:
+            counts[row['product']] += 1
+            type_ = (row['attribute.'] or {}).get('type_')
+            if type_ not in self.types:
+                continue
+            key = (row['attribute_set'], row['attribute'],
+                row['value_%s' % type_])
+            products[key][row['product']] = row['id']
+        self.products = dict(products)
+        self.counts = dict(counts)
+        self.size = sum(len(p) for p in self.products.values()) + len(counts)
+        self.memory = (sys.getsizeof(self.products)
+            + sum(sys.getsizeof(p) for p in self.products.values())
+            + sys.getsizeof(self.counts))
+
+    @classmethod
+    def supports(cls, criteria):
+        "Return if the criteria can be resolved by the index"
+        for child, attribute, op, value in criteria:
+            types = cls.types.get(attribute.type_)
+            if (op != '=' or not types
+                    or not (value is None or isinstance(value, types))):
+                return False
+        return True
+
+    def match(self, criteria):
+        "Return the id of the product matching the criteria or None"
+        candidates = None
+        for child, attribute, op, value in criteria:
+            products = self.products.get(
+                (child.attribute_set.id, attribute.id, value), {})
+            if candidates is None:
+                candidates = set(products)
+            else:
+                candidates &= products.keys()
+            if not candidates:
+                return
+        candidates = [p for p in candidates
+            if self.counts[p] <= len(criteria)]
+        if candidates:
+            # As the query, prefer the product of the latest attribute
+            # matching the last criterion
+            return max(candidates, key=products.get)
+
+
+class PricedItem:
+    '''
+    Product generated by a BOM or purchase product property when only the
+    prices of a design are computed.
+
+    It replaces the template, product and BOM records built when the design
+    is processed.
+    '''
+    __slots__ = ('property', 'code', 'name', 'product', 'quantity', 'uom')
+
+    def __init__(self, property, code, name, product=None, quantity=None,
+            uom=None):
+        self.property = property
+        self.code = code
+        self.name = name
+        self.product = product
+        self.quantity = quantity
+        self.uom = uom
+
+    def __repr__(self):
+        return '<PricedItem %s %s>' % (self.property.id, self.code)
+
+
+class EvaluationContext(dict):
+    '''
+    Values of a design BOM level together with the names they expose to
+    Property.evaluate.
+
+    The names are kept up to date as values are set, so formulas evaluated
+    against the same context do not rebuild them on every call.
+    '''
+
+    def __init__(self, design, values=None):
+        pool = Pool()
+        SupplierIPNR = pool.get('product_supplier.ipnr')
+        super().__init__()
+        self.design = design
+        # The IPNR lookup is shared by every context instead of copied
+        self.names = ChainMap({}, SupplierIPNR.get_lookup(), {'math': math})
+        for sup in design.suppliers:
+            self.names[sup.category.name] = sup.supplier
+        if values:
+            self.update(values)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._set_name(key, value)
+
+    def update(self, values):
+        super().update(values)
+        keys = [x for x in values.keys() if not isinstance(x, str)]
+        keys.sort(key=property_sequence)
+        keys += [x for x in values.keys() if isinstance(x, str)]
+        for key in keys:
+            self._set_name(key, values[key])
+
+    def _set_name(self, key, value):
+        if isinstance(value, dict):
+            return
+        if isinstance(key, str):
+            self.names[key] = value
+            return
+        # Values keyed by code take precedence over the ones keyed by property
+        if isinstance(self.get(key.code, {}), dict):
+            self.names[key.code] = value
+
 
 class SupplierProductIpnr(ModelSQL, ModelView):
     'Supplier Product IPNR'
@@ -51,6 +328,29 @@ class SupplierProductIpnr(ModelSQL, ModelView):
     product = fields.Many2One('product.product', 'Product', required=True)
     color = fields.Many2One('product.product', 'Color', required=True)
     ipnr = fields.Float('IPNR', required=True)
+    _lookup_cache = Cache('product_supplier.ipnr.lookup', context=False)
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Design = pool.get('configurator.design')
+        super().on_modification(mode, records, field_names=field_names)
+        cls._lookup_cache.clear()
+        Design.clear_full_dict()
+        Design.clear_prices_cache()
+
+    @classmethod
+    def get_lookup(cls):
+        "Return the IPNR values keyed by product, color and supplier code"
+        lookup = cls._lookup_cache.get(None)
+        if lookup is None:
+            lookup = {}
+            for sup in cls.search([]):
+                code = sup.product.code + '_' + sup.color.code + '_' + str(
+                    sup.supplier.code)
+                lookup[code] = sup.ipnr
+            lookup = cls._lookup_cache.set(None, lookup)
+        return lookup
 
 
 class PriceCategory(ModelSQL, ModelView):
@@ -111,7 +411,9 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
                 'options', 'group', 'match']))
         })
     parent = fields.Many2One('configurator.property', 'Parent',
-        ondelete='CASCADE')
+        ondelete='CASCADE', left='left', right='right')
+    left = fields.Integer('Left', required=True)
+    right = fields.Integer('Right', required=True)
     quantity = fields.Char('Quantity', states={
         'invisible': Not(Eval('type').in_(['purchase_product',
             'bom', 'product', 'function', 'match'])),
@@ -217,11 +519,53 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
     parent_bom = fields.Function(fields.Many2One('configurator.property',
         'Parent BOM'),
         'get_parent_bom')
+    _expression_cache = Cache('configurator.property.expression',
+        context=False)
+    _template_names_cache = Cache('configurator.property.template_names',
+        context=False)
+    _match_cache = Cache('configurator.property.match', context=False)
+    # Tokens of the valid match indexes by supplier
+    _match_index_cache = Cache('configurator.property.match_index',
+        context=False)
+    # Match indexes by database and supplier, least recently used first
+    _match_indexes = OrderedDict()
+    _match_indexes_lock = threading.Lock()
+    _tree_cache = Cache('configurator.property.tree', context=False)
+    # Names of the fields copied to the generated records by model
+    _copy_plans = {}
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.left, Index.Range(cardinality='high')),
+                (t.right, Index.Range(cardinality='high'))))
+
+    @classmethod
+    def on_modification(cls, mode, properties, field_names=None):
+        pool = Pool()
+        Design = pool.get('configurator.design')
+        super().on_modification(mode, properties, field_names=field_names)
+        cls.clear_match_cache()
+        cls._tree_cache.clear()
+        Design._function_values_cache.clear()
+        Design.clear_full_dict()
+        Design.clear_prices_cache()
 
     @staticmethod
     def default_hidden():
         return False
 
+    @classmethod
+    def default_left(cls):
+        return 0
+
+    @classmethod
+    def default_right(cls):
+        return 0
+
     @staticmethod
     def default_sequence():
         return 99
@@ -233,6 +577,29 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
     def get_parent_bom(self, name=None):
         return self.get_parent()
 
+    @classmethod
+    def get_tree(cls):
+        "Return the PropertyNode of every property keyed by id"
+        nodes = cls._tree_cache.get(None)
+        if nodes is None:
+            table = cls.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*table.select(table.id, table.parent, table.code,
+                    table.type, table.sequence, table.active))
+            keys = ('id', 'parent', 'code', 'type', 'sequence', 'active')
+            nodes = PropertyNode.build(dict(zip(keys, r)) for r in cursor)
+            nodes = cls._tree_cache.set(None, nodes)
+        return nodes
+
+    def get_node(self):
+        "Return the PropertyNode of the property if it is stored unchanged"
+        if self.id is None or self.id < 0:
+            return
+        if self._values and {'parent', 'code', 'type', 'sequence',
+                'active'} & set(self._values._keys()):
+            return
+        return self.get_tree().get(self.id)
+
     @classmethod
     def search_childrens(cls, name, clause):
         childrens = cls.search([('parent', '!=', None),
@@ -244,6 +611,9 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
 
     def get_childrens(self, name):
         Property = Pool().get('configurator.property')
+        node = self.get_node()
+        if node:
+            return list(node.childrens)
         parent = self
         if self.type != 'bom':
             parent = self.get_parent()
@@ -261,7 +631,11 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
 
     def get_rec_name(self, name):
         res = ''
-        parent = self.get_parent()
+        node = self.get_node()
+        if node:
+            parent = self.get_tree()[node.bom]
+        else:
+            parent = self.get_parent()
         if self.code:
             res = '[%s] ' % self.code
         if self.code and parent and parent.parent:
@@ -270,6 +644,9 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
         return res
 
     def get_full_code(self):
+        node = self.get_node()
+        if node:
+            return node.full_code
         res = ''
         parent = self.get_parent()
         if self.code:
@@ -279,6 +656,9 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
         return res
 
     def get_full_path(self):
+        node = self.get_node()
+        if node:
+            return node.full_path
         res = ''
         parent = self.parent
         if self.code and self.parent:
@@ -290,8 +670,10 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
 
 
     def render_expression_record(self, expression, record, field=None):
+        pool = Pool()
+        JinjaTemplate = pool.get('configurator.jinja_template')
         try:
-            template = Jinja2Template(expression, trim_blocks=True)
+            template = JinjaTemplate.get_template(expression)
             res = template.render(record)
         except (TypeError, TemplateSyntaxError, Jinja2UndefinedError):
             raise UserError(gettext(
@@ -381,6 +763,11 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
             return self.product_template.default_uom_category.id
 
     def get_parent(self, name=None):
+        node = self.get_node()
+        if node:
+            if node.bom == self.id:
+                return self
+            return self.__class__(node.bom)
         if self.type == 'bom':
             return self
         if not self.parent:
@@ -424,56 +811,58 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
         if to_create:
             CreatedObject.save(to_create)
 
-    def evaluate(self, expression, values, design):
-        pool = Pool()
-        SupplierIPNR = pool.get('product_supplier.ipnr')
-        supplierIpnr = SupplierIPNR.search([])
-
-        flat = {}
-        custom_locals = copy(locals())
-        custom_locals.update(flat)
-        custom_locals['math'] = math
-        keys = values.keys()
-        for sup in supplierIpnr:
-            code = sup.product.code + '_' + sup.color.code + '_' + str(
-                sup.supplier.code)
-            custom_locals[code] = sup.ipnr
+    @classmethod
+    def parse_expression(cls, expression):
+        "Return the parsed tree of expression, parsing it only once"
+        parsed = cls._expression_cache.get(expression)
+        if parsed is None:
+            parsed = SimpleEval.parse(expression)
+            cls._expression_cache.set(expression, parsed)
+            logger.debug('Expression cache: %s hits, %s misses',
+                cls._expression_cache.hit, cls._expression_cache.miss)
+        return parsed
 
-        for sup in design.suppliers:
-            code = sup.category.name
-            custom_locals[code] = sup.supplier
-
-        att_keys = [x for x in values.keys() if not isinstance(x, str)]
-        str_keys = [x for x in keys if isinstance(x, str)]
-        att_keys.sort(key=lambda x: (str(x.parent and x.parent.sequence or 0
-             ).zfill(5) + str(x.sequence).zfill(6)))
-        att_keys += str_keys
-        for prop in att_keys:
-            attr = values[prop]
-            if isinstance(attr, dict):
-                continue
-            elif isinstance(prop, str):
-                custom_locals[prop] = attr
-                continue
-            if prop.type == 'function':
-                custom_locals[prop.code] = attr
-            else:
-                custom_locals[prop.code] = attr
+    @classmethod
+    def get_expression_names(cls, expression):
+        "Return the names referenced by expression"
+        if not expression:
+            return set()
         try:
-            res = simple_eval(expression, names=custom_locals, functions={
-                    'Decimal': Decimal,
-                    'abs': abs,
-                    'bool': bool,
-                    'float': float,
-                    'int': int,
-                    'len': len,
-                    'max': max,
-                    'min': min,
-                    'pow': pow,
-                    'round': round,
-                    'str': str,
-                    'sum': sum,
-                    })
+            parsed = cls.parse_expression(expression)
+        except Exception:
+            # As evaluate, tolerate any invalid formula
+            return set()
+        return {x.id for x in ast.walk(parsed) if isinstance(x, ast.Name)}
+
+    @classmethod
+    def get_template_names(cls, source):
+        "Return the variables referenced by the Jinja template source"
+        if not source:
+            return set()
+        names = cls._template_names_cache.get(source)
+        if names is None:
+            try:
+                names = jinja2_meta.find_undeclared_variables(
+                    Jinja2Environment().parse(source))
+            except TemplateSyntaxError:
+                names = set()
+            names = cls._template_names_cache.set(source, names)
+        return names
+
+    def evaluate(self, expression, values, design):
+        if not isinstance(values, EvaluationContext):
+            values = EvaluationContext(design, values)
+        custom_locals = ChainMap(values.names, {
+                'self': self,
+                'expression': expression,
+                'values': values,
+                'design': design,
+                })
+        try:
+            evaluator = SimpleEval(names=custom_locals,
+                functions=EVAL_FUNCTIONS)
+            res = evaluator.eval(expression,
+                previously_parsed=self.parse_expression(expression))
             if self.evaluate_2times:
                 res = custom_locals.get(res, 0)
             return res
@@ -502,8 +891,7 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
             val = values[parent]
 
         if self.type != 'match':
-            enviroment = full.copy()
-            enviroment.update(val)
+            enviroment = design.get_evaluation_context(val, full)
         else:
             enviroment = val
 
@@ -514,6 +902,74 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
         created_obj.update(res)
         return created_obj
 
+    @classmethod
+    def clear_match_cache(cls):
+        "Forget the matched products and the match indexes"
+        cls._match_cache.clear()
+        cls._match_index_cache.clear()
+
+    @classmethod
+    def get_match_index(cls, supplier):
+        '''
+        Return the MatchIndex of supplier or None if it exceeds the size of
+        the indexes.
+
+        The suppliers exceeding the size are remembered until their products
+        change, so their attributes are not loaded again.
+        '''
+        pool = Pool()
+        ProductAttribute = pool.get('product.product.attribute')
+        transaction = Transaction()
+        size_limit = config_.config.getint(
+            'product_dynamic_configurator', 'match_index_size',
+            default=1000000)
+
+        key = (transaction.database.name, supplier.id)
+        token = cls._match_index_cache.get(supplier.id)
+        if token is False:
+            return
+        with cls._match_indexes_lock:
+            index_token, index = cls._match_indexes.pop(key, (None, None))
+            if token is not None and index_token == token:
+                cls._match_indexes[key] = (index_token, index)
+                return index
+
+        domain = [
+            ('product.type', '=', 'service'),
+            ('product.product_suppliers.party', '=', supplier.id),
+            ]
+        count = ProductAttribute.search(domain, count=True)
+        index = None
+        if count <= size_limit:
+            attributes = ProductAttribute.search(domain, order=[])
+            index = MatchIndex(ProductAttribute.read(
+                    [a.id for a in attributes],
+                    ['product', 'attribute_set', 'attribute',
+                        'attribute.type_']
+                    + ['value_%s' % t for t in MatchIndex.types]))
+        if index is None or index.size > size_limit:
+            logger.debug('Match index of supplier %s not kept: %s attributes',
+                supplier.id, count)
+            cls._match_index_cache.set(supplier.id, False)
+            return
+
+        token = (transaction.started_at, id(index))
+        with cls._match_indexes_lock:
+            cls._match_indexes.pop(key, None)
+            size = index.size
+            for other_token, other in cls._match_indexes.values():
+                size += other.size
+            while size > size_limit:
+                _, (_, other) = cls._match_indexes.popitem(last=False)
+                size -= other.size
+            cls._match_indexes[key] = (token, index)
+            indexes = len(cls._match_indexes)
+        cls._match_index_cache.set(supplier.id, token)
+        logger.debug('Match index of supplier %s: %s entries (%s bytes), '
+            '%s entries in %s indexes', supplier.id, index.size, index.memory,
+            size, indexes)
+        return index
+
     def get_match_domain(self, design):
         return []
 
@@ -522,20 +978,8 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
         Product = pool.get('product.product')
         BomInput = pool.get('production.bom.input')
         Uom = pool.get('product.uom')
-        ProductAttribute = pool.get('product.product.attribute')
-        domain = []
-
-        suppliers = dict((x.category, x.supplier) for x in design.suppliers)
-        main_products_filter = []
-        if self.quotation_category and self.quotation_category in suppliers:
-            domain += [
-                ('type', '=', 'service'),
-                ('product_suppliers.party', '=',
-                    suppliers[self.quotation_category].id)]
-            main_products_filter = [x.id for x in Product.search(domain)]
-
-        products_filter = None
 
+        criteria = []
         for child in self.childs:
             attribute = child.product_attribute
             value = self.evaluate(child.product_attribute_value, values, design)
@@ -553,35 +997,21 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
             type_ = attribute.type_
             if type_ == 'integer' and isinstance(value, bool):
                 value = value and 1 or 0
-            domain = [
-                ('attribute_set', '=', child.attribute_set.id),
-                ('attribute.id', '=', attribute.id),
-                ('value_%s' % type_, op, value),
-               ]
-            if products_filter is not None:
-                pfilter = ([x.product.id for x in products_filter if x.product
-                    and x.product.id in main_products_filter])
-                domain += [('product', 'in', pfilter)]
-            else:
-                domain += [('product', 'in', main_products_filter)]
-
-            products_filter = ProductAttribute.search(domain)
-
-            if products_filter is None:
-                return {self: (None, [])}
-
-        products = products_filter
-        if not products:
-            return {self: (None, [])}
+            criteria.append((child, attribute, op, value))
 
-        products = [x.product for x in products
-            if x.product and x.product.type == 'service']
-
-        product = None
-        for prod in products:
-            if len(prod.attributes) > len(self.childs):
-                continue
-            product = prod
+        suppliers = dict((x.category, x.supplier) for x in design.suppliers)
+        supplier = None
+        if self.quotation_category:
+            supplier = suppliers.get(self.quotation_category)
+
+        key = (self.id, supplier and supplier.id,
+            tuple((a.id, op, v) for _, a, op, v in criteria))
+        product = self._match_cache.get(key, -1)
+        if product == -1:
+            product = self.match_product(supplier, criteria)
+            self._match_cache.set(key, product and product.id)
+        elif product is not None:
+            product = Product(product)
 
         if not product:
             return {self: (None, [])}
@@ -600,6 +1030,68 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
         bom_input.quantity = quantity
         return {self: (bom_input, [])}
 
+    def match_product(self, supplier, criteria):
+        """
+        Return the service product of supplier whose attributes match the
+        criteria, a list of (child property, attribute, operator, value).
+
+        The candidates are found by a single query grouping the attribute
+        values matched by each product.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        ProductAttribute = pool.get('product.product.attribute')
+        cursor = Transaction().connection.cursor()
+
+        if not supplier or not criteria:
+            return
+        if MatchIndex.supports(criteria):
+            index = self.get_match_index(supplier)
+            if index is not None:
+                product = index.match(criteria)
+                return product and Product(product)
+
+        products = Product.search([
+                ('type', '=', 'service'),
+                ('product_suppliers.party', '=', supplier.id),
+                ], order=[], query=True)
+
+        matches = []
+        for i, (child, attribute, op, value) in enumerate(criteria):
+            type_ = attribute.type_
+            attributes = ProductAttribute.search([
+                    ('attribute_set', '=', child.attribute_set.id),
+                    ('attribute.id', '=', attribute.id),
+                    ('value_%s' % type_, op, value),
+                    ], order=[], query=True)
+            table = ProductAttribute.__table__()
+            matches.append(table.select(
+                    table.product, Literal(i).as_('criterion'), table.id,
+                    where=table.id.in_(attributes)))
+        matches = Union(*matches, all_=True)
+
+        # Products with more attributes than criteria are not a match
+        table = ProductAttribute.__table__()
+        extra = table.select(table.product,
+            where=table.product != Null,
+            group_by=[table.product],
+            having=Count(table.id) > len(criteria))
+
+        # As the last criterion search did, prefer the product of its latest
+        # matching attribute
+        last = Max(Case((matches.criterion == len(criteria) - 1, matches.id)))
+        cursor.execute(*matches.select(matches.product,
+                where=matches.product.in_(products)
+                & ~matches.product.in_(extra),
+                group_by=[matches.product],
+                having=Count(matches.criterion, distinct=True)
+                == len(criteria),
+                order_by=[last.desc],
+                limit=1))
+        row = cursor.fetchone()
+        if row:
+            return Product(row[0])
+
     def get_number(self, design, values, created_obj, full):
         pass
 
@@ -613,14 +1105,9 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
 
 
     def get_options(self, design, values, created_obj, full):
-        pool = Pool()
-        Attribute = pool.get('configurator.design.attribute')
-
-        attr = Attribute.search([('property', '=', self.id),
-            ('design', '=', design.id)])
+        attr = design.get_design_attribute(self)
         attribute = values.get(self.code)
 
-        attr = attr and attr[0]
         if attribute is not None and attr and attr.option is not None:
             res = attr.option.create_prices(design, values, full)
             option = res.get(attribute, None)
@@ -674,13 +1161,41 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
         elif prop.product_attribute.type_ == 'selection':
             raise 'Not Implemented'
 
+    @classmethod
+    def get_copy_plan(cls, Model):
+        '''
+        Return the names of the fields of Model copied to generated records.
+
+        Only the stored or settable fields are copied, except the One2Many and
+        the model fields listed in the copy_exclude option of the
+        product_dynamic_configurator section (as model.field).
+        '''
+        plan = cls._copy_plans.get(Model)
+        if plan is None:
+            exclude = {'id', 'create_uid', 'create_date', 'write_uid',
+                'write_date'}
+            for name in config_.config.get('product_dynamic_configurator',
+                    'copy_exclude', default='').replace(',', ' ').split():
+                model, field = name.rsplit('.', 1)
+                if model == Model.__name__:
+                    exclude.add(field)
+            plan = []
+            for name, field in Model._fields.items():
+                if name in exclude or isinstance(field, fields.One2Many):
+                    continue
+                if isinstance(field, fields.Function) and not field.setter:
+                    continue
+                plan.append(name)
+            plan = cls._copy_plans[Model] = tuple(sorted(plan))
+        return plan
+
     def get_product_template_object_copy(self, template):
         Template = Pool().get('product.template')
-        ntemplate = Template()
+        values, = Template.read([template.id], self.get_copy_plan(Template))
+        del values['id']
+        ntemplate = Template(**values)
         ntemplate.attribute_set = None
         ntemplate.attributes = tuple()
-        for f in template._fields:
-            setattr(ntemplate, f, getattr(template, f))
         ntemplate.configurator_template = False
         ntemplate.categories_all = None
         ntemplate.products = []
@@ -689,11 +1204,8 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
 
     def get_product_product_object_copy(self, product):
         Product = Pool().get('product.product')
+        # The fields of the variant are not copied, only the template ones
         nproduct = Product()
-        for f in product._fields:
-            if not hasattr(nproduct, f):
-                continue
-            setattr(nproduct, f, getattr(product, f))
         nproduct.attributes = tuple()
         nproduct.account_category = None
         nproduct.template = None
@@ -713,6 +1225,10 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
         return attribute_set.render_expression_record(name_field, values)
 
     def get_property_code(self, design, custom_locals):
+        # Codes already rendered by Design.prefetch_products for the run
+        locals_, codes = getattr(design, '_property_codes', (None, {}))
+        if locals_ is custom_locals and self.id in codes:
+            return codes[self.id]
         code = design.render_field(self, 'code_jinja', custom_locals)
         code = code and code.strip()
         return code
@@ -726,19 +1242,16 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
         pool = Pool()
         BomInput = pool.get('production.bom.input')
         Uom = pool.get('product.uom')
-        Product = pool.get('product.product')
         ProductCostPrice = pool.get('product.cost_price')
         Attribute = pool.get('product.product.attribute')
-        DesignAttribute = pool.get('configurator.design.attribute')
         ProductSupplier = pool.get('purchase.product_supplier')
         Price = pool.get('purchase.product_supplier.price')
 
         exists = False
 
         if self.parent and self.parent.type == 'options':
-            attr = DesignAttribute.search([('property', '=', self.parent.id),
-                ('design', '=', design.id)])
-            if not attr or attr and attr[0].option is None:
+            attr = design.get_design_attribute(self.parent)
+            if not attr or attr.option is None:
                 return
 
         if (values.get('PR_MB_0A') and values['PR_MB_0A'].code == 'PR_MB_0A_SI'
@@ -749,6 +1262,15 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
         if not self.product_template:
             return
 
+        if Transaction().context.get('prices', False):
+            code = (self.get_property_code(design, full)
+                or "purchase (%s)" % design.id)
+            products = [p for p in design.get_existing_products(code)
+                if p.template.default_uom
+                == self.product_template.default_uom]
+            return {self: (self.get_priced_item(
+                        design, values, full, code, products), [])}
+
         custom_locals =  full # design.design_full_dict()
         template = self.get_product_template_object_copy(self.product_template)
         template.name = self.name or '' + "(" + design.name or '' + ")"
@@ -804,9 +1326,9 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
             template._update_attributes_values()
         template.products = None
 
-        exists_product = Product.search(
-            [('template.code', '=', template.code),
-              ('template.default_uom', '=', template.default_uom)])
+        exists_product = [p for p in design.get_existing_products(
+                template.code)
+            if p.template.default_uom == template.default_uom]
 
         if exists_product:
             product = exists_product[0]
@@ -872,28 +1394,27 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
         else:
             product.product_suppliers = []
 
+        priced = [prop for prop, v in created_obj.items()
+            if v[0] and prop.type in ('product', 'match', 'bom')]
         for quote in design.prices:
             if hasattr(quote, 'state') and quote.state != 'confirmed':
                 continue
 
+            lines = defaultdict(list)
+            for line in quote.prices:
+                lines[line.property].append(line)
+
             cost_price = 0
             uom = None
             qty = Uom.compute_qty(design.template.uom, design_qty,
                 design.quotation_uom)
-            for prop, v in created_obj.items():
-                v = v[0]
-                if not v or prop.type not in ('product', 'match', 'bom'):
-                    continue
-                for line in quote.prices:
-                    if line.property != prop:
-                        continue
+            for prop in priced:
+                for line in lines[prop]:
                     cost_price += line.unit_price
                     uom = line.uom
 
             if self.option_price_property:
-                for line in quote.prices:
-                    if line.property != self.option_price_property:
-                        continue
+                for line in lines[self.option_price_property]:
                     cost_price = line.manual_unit_price or line.unit_price
 
             if cost_price:
@@ -905,7 +1426,8 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
                         'product_dynamic_configurator.msg_product_supplier_price',
                         name=self.rec_name,
                         quote=quote.rec_name,
-                        product=template.rec_name,
+                        product=(template if exists
+                            else self.product_template).rec_name,
                         price_qty=price_qty,
                         quote_quantity=quote.quantity,
                         qty=qty,
@@ -990,10 +1512,10 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
 
     def get_bom(self, design, values, created_obj, full):
         pool = Pool()
-        Product = pool.get('product.product')
         Bom = pool.get('production.bom')
         BomInput = pool.get('production.bom.input')
         BomOutput = pool.get('production.bom.output')
+        Product = pool.get('product.product')
         ProductBom = pool.get('product.product-production.bom')
         Operation = pool.get('production.route.operation')
         Route = pool.get('production.route')
@@ -1007,6 +1529,14 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
                 return create_bom_input(property_.parent)
             return True
 
+        if Transaction().context.get('prices', False):
+            if not self.product_template:
+                return
+            code = (self.get_property_code(design, full)
+                or "%s (%s)" % (self.code, 'Id' + str(design.id)))
+            return {self: (self.get_priced_item(design, values, full, code,
+                        design.get_existing_products(code)), [])}
+
         res_obj = []
         bom = Bom()
         bom.name = "%s (%s)" % (self.name, (design.code or str(design.id)))
@@ -1120,8 +1650,7 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
                     pass
                 setattr(template, key, val)
 
-        exists_product = Product.search([
-                ('template.code', '=', template.code)])
+        exists_product = design.get_existing_products(template.code)
         if exists_product:
             product = exists_product[0]
             template = product.template
@@ -1139,10 +1668,6 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
         if context.get('prices', False):
             quantity = self.quantity
 
-        to_delete = [x for x in product.boms]
-        if update:
-            ProductBom.delete(to_delete)
-
         output = BomOutput()
         output.bom = bom
         output.product = product
@@ -1151,6 +1676,32 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
             self.evaluate(quantity, values, design), product.default_uom)
         bom.outputs += (output,)
         bom.name = "(%s) %s" % (template.code, template.name)
+
+        # Link the existing equivalent BOM instead of creating a new one
+        equivalent = None
+        if exists_product:
+            digest = self.get_bom_digest(bom, route)
+            if digest is not None:
+                for product_bom in product.boms:
+                    if digest == self.get_bom_digest(
+                            product_bom.bom, product_bom.route):
+                        equivalent = product_bom
+                        break
+
+        to_delete = [x for x in product.boms if x != equivalent]
+        if update:
+            ProductBom.delete(to_delete)
+
+        if equivalent:
+            # The outputs of the reused BOM are other instances of product so
+            # it is saved with the created records
+            to_save = []
+            if update:
+                if 'phantom' in Product._fields:
+                    product.phantom = True
+                to_save.append(product)
+            return {self: (equivalent.bom, to_save)}
+
         product_bom = ProductBom()
         product_bom.product = product
         product_bom.bom = bom
@@ -1165,6 +1716,57 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
     def template_update(self, template, bom, design):
         return template
 
+    @classmethod
+    def get_bom_digest(cls, bom, route=None):
+        '''
+        Return the digest of the inputs, outputs and route operations of the
+        BOM or None if any of its products is not saved.
+        '''
+        def key(value):
+            if isinstance(value, Model):
+                return value.id
+            return value
+
+        def lines(lines):
+            result = []
+            for line in lines:
+                if line.product.id is None or line.product.id < 0:
+                    return
+                result.append(repr((line.product.id, key(line.unit),
+                            line.quantity)))
+            return sorted(result)
+
+        inputs, outputs = lines(bom.inputs), lines(bom.outputs)
+        if inputs is None or outputs is None:
+            return
+        operations = None
+        if route:
+            operations = (key(route.uom), [
+                    tuple(key(getattr(operation, name, None))
+                        for name in cls._bom_digest_operation_fields())
+                    for operation in route.operations])
+        return hashlib.sha256(repr((inputs, outputs, operations)).encode(
+                'utf-8')).hexdigest()
+
+    @staticmethod
+    def _bom_digest_operation_fields():
+        return ['work_center_category', 'operation_type', 'time', 'time_uom',
+            'quantity', 'quantity_uom', 'calculation']
+
+    def get_priced_item(self, design, values, full, code, products):
+        '''
+        Return the PricedItem of the product generated with code, or of the
+        first of the existing products.
+        '''
+        name = self.get_property_name(design, full) or self.name
+        product = None
+        if products:
+            product = products[0]
+            code = product.template.code
+            name = product.template.name
+        quantity = self.evaluate(self.quantity, values, design)
+        return PricedItem(self, code, name, product, quantity, self.uom)
+
 
     def get_ratio_for_prices(self, values, ratio, design):
         quantity = self.bom_quantity or self.quantity
@@ -1185,6 +1787,38 @@ class Property(DeactivableMixin, tree(separator=' / '), sequence_ordered(),
         return parent.get_ratio_for_prices(values,
             (ratio or 1.0) * ratio_parent, design)
 
+    def get_price_ratio(self, values, design):
+        '''
+        Return get_ratio_for_prices(values, 1, design) memoised on the design.
+
+        The ratio of a property is the ratio of its parent times its own
+        factor, so the ratio of each ancestor is computed once per values and
+        pricing run and shared by all its descendants.
+        '''
+        ratios = getattr(design, '_price_ratios', None)
+        if ratios is None:
+            ratios = design._price_ratios = {}
+        # Keep a reference to values so its id is not reused
+        ratios = ratios.setdefault(id(values), (values, {}))[1]
+        prices = Transaction().context.get('prices', False)
+
+        path = []
+        node = self
+        while node and node.id not in ratios:
+            path.append(node)
+            node = node.parent
+        for node in reversed(path):
+            parent = node.parent or node
+            quantity = parent.bom_quantity or parent.quantity
+            if prices:
+                quantity = parent.quantity
+            factor = node.evaluate(quantity or '1.0', values, design) or 1.0
+            if node.parent:
+                ratios[node.id] = factor * ratios[parent.id]
+            else:
+                ratios[node.id] = 1.0 / factor
+        return ratios[self.id]
+
     def create_design_line(self, quantity, uom, unit_price, quote):
         DesignLine = Pool().get('configurator.design.line')
         Uom = Pool().get('product.uom')
@@ -1250,6 +1884,13 @@ READONLY_STATE = {
 
 STATES = [('draft', 'draft'), ('done', 'Done'), ('cancel', 'Cancel')]
 
+REQUOTE_STATES = [
+    (None, ''),
+    ('queued', 'Queued'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+    ]
+
 
 class Design(Workflow, ModelSQL, ModelView):
     'Design'
@@ -1331,6 +1972,17 @@ class Design(Workflow, ModelSQL, ModelView):
         fields.Many2One('product.uom.category', 'Product Uom Category'),
         'on_change_with_product_uom_category')
     product_codes = fields.Text('Product Codes', readonly=True)
+    requote_state = fields.Selection(REQUOTE_STATES, 'Re-quote State',
+        readonly=True)
+    requote_date = fields.DateTime('Re-quote Date', readonly=True)
+    requote_error = fields.Text('Re-quote Error', readonly=True)
+    _function_values_cache = Cache('configurator.design.function_values',
+        context=False)
+    _prices_cache = Cache('configurator.design.prices', context=False)
+    # design_full_dict results by transaction, then by design and language
+    _full_dicts = WeakKeyDictionary()
+    _full_dict_hits = 0
+    _full_dict_misses = 0
 
     @classmethod
     def __setup__(cls):
@@ -1359,6 +2011,30 @@ class Design(Workflow, ModelSQL, ModelView):
             },
         })
 
+    @classmethod
+    def on_modification(cls, mode, designs, field_names=None):
+        super().on_modification(mode, designs, field_names=field_names)
+        if (mode == 'delete' or field_names is None
+                or {'template', 'attributes', 'suppliers'} & set(field_names)):
+            cls.clear_full_dict(designs)
+
+    @classmethod
+    def clear_full_dict(cls, designs=None):
+        '''
+        Forget the design_full_dict results of the current transaction.
+
+        Only the results of designs are forgotten if they are given.
+        '''
+        transaction = Transaction()
+        if designs is None:
+            cls._full_dicts.pop(transaction, None)
+            return
+        full_dicts = cls._full_dicts.get(transaction, {})
+        ids = {d.id for d in designs}
+        for key in list(full_dicts):
+            if key[0] in ids:
+                del full_dicts[key]
+
     @staticmethod
     def default_currency():
         Company = Pool().get('company.company')
@@ -1388,7 +2064,7 @@ class Design(Workflow, ModelSQL, ModelView):
         self.code = self.template.render_expression_record(
             self.template.code_jinja and self.template.code_jinja.full_content
             or '', custom_locals) or self.code
-        self.product_exists = self.get_product_exist()
+        self.product_exists = self.get_product_exist([self])[self.id]
 
     @fields.depends('template', 'name', methods=['design_full_dict'])
     def on_change_manual_name(self):
@@ -1427,23 +2103,32 @@ class Design(Workflow, ModelSQL, ModelView):
         default.setdefault('objects', None)
         default.setdefault('product', None)
         default.setdefault('product_codes', None)
+        default.setdefault('requote_state', None)
+        default.setdefault('requote_date', None)
+        default.setdefault('requote_error', None)
         return super(Design, cls).copy(designs, default=default)
 
-    def get_product_exist(self, name=None):
-        if self.product:
-            return self.product.id
-        if not self.code:
-            return None
+    @classmethod
+    def get_product_exist(cls, designs, name=None):
         Product = Pool().get('product.product')
+        res = {}
+        codes = set()
+        for design in designs:
+            res[design.id] = design.product and design.product.id
+            if not design.product and design.code:
+                codes.add(design.code)
+        if not codes:
+            return res
+        products = {}
         with Transaction().set_context(active_test=False):
-            products = Product.search([
-                ('code', '=', self.code),
-                ], limit=1,
-                order=[('active', 'DESC')])
-        if not products:
-            return None
-        product, = products
-        return product.id
+            for product in Product.search([
+                        ('code', 'in', list(codes)),
+                        ], order=[('active', 'DESC')]):
+                products.setdefault(product.code, product.id)
+        for design in designs:
+            if not design.product and design.code:
+                res[design.id] = products.get(design.code)
+        return res
 
     @classmethod
     @ModelView.button
@@ -1456,18 +2141,21 @@ class Design(Workflow, ModelSQL, ModelView):
         SupplierIPNR = pool.get('product_supplier.ipnr')
         Function = pool.get('configurator.property')
 
-        boms = Function.search([('type', '=', 'bom'),
-            ('id' , '!=', self.template.id),
-            ('parent', 'child_of', [self.template.id])])
-
-        functions = Function.search([('type', '=', 'function'),
-            ('parent', 'child_of', [self.template.id])])
-        res = {}
-
+        properties = Function.search([
+                ('parent', 'child_of', [self.template.id]),
+                ])
+        boms = [x for x in properties
+            if x.type == 'bom' and x != self.template]
+        functions = [x for x in properties if x.type == 'function']
+        res = EvaluationContext(self)
+
+        # Attribute property ids by the (scope, name) formulas use to read them
+        attributes = {}
+        inputs = {}
         for attribute in self.attributes:
             parent = attribute.property.get_parent()
             if parent not in res:
-                res[parent] = {}
+                res[parent] = EvaluationContext(self)
             if attribute.property.type == 'number':
                 res[parent][attribute.property.code] = attribute.number
             elif attribute.property.type == 'options':
@@ -1475,6 +2163,11 @@ class Design(Workflow, ModelSQL, ModelView):
             elif attribute.property.type == 'text':
                 res[parent][attribute.property.code] = attribute.text
             #res[parent][attribute.property] = attribute.number or attribute.option or attribute.text
+            if attribute.property.type in ('number', 'options', 'text'):
+                attributes[(parent, attribute.property.code)] = (
+                    attribute.property.id)
+                inputs[attribute.property.id] = (attribute.number,
+                    attribute.option and attribute.option.id, attribute.text)
             if boms:
                 code = attribute.property.get_full_code()
                 if attribute.property.type == 'number':
@@ -1484,39 +2177,306 @@ class Design(Workflow, ModelSQL, ModelView):
                 elif attribute.property.type == 'text':
                     res[code] = attribute.text
                 #res[code] = attribute.number or attribute.option or attribute.text
+                if attribute.property.type in ('number', 'options', 'text'):
+                    attributes[(None, code)] = attribute.property.id
 
 
-        functions.sort(key=lambda x: (
-                str(x.parent and x.parent.sequence or 0).zfill(5) +
-                str(x.sequence).zfill(6)))
-
         root = self.template
+        functions.sort(key=property_sequence)
+        depends, references = self.get_function_dependencies(functions,
+            attributes, bool(boms))
+        ordered = self.get_function_order(functions, properties, depends)
+        # Functions no output depends on are left without value
+        evaluated = set(ordered)
         for function_ in functions:
+            if function_ in evaluated:
+                continue
+            res[function_.get_parent()][function_] = None
+            if boms:
+                res[function_.get_full_code()] = None
+
+        # Reuse the values of the previous run for the functions that do not
+        # depend on a changed attribute
+        previous = None
+        if self.id is not None and self.id >= 0:
+            previous = self._function_values_cache.get(self.id)
+        if previous and previous['template'] == self.template.id:
+            changed = {x for x in set(inputs) | set(previous['inputs'])
+                if inputs.get(x) != previous['inputs'].get(x)}
+            previous_values = previous['functions']
+        else:
+            changed = set()
+            previous_values = {}
+        recomputed = set()
+        cached_values = {}
+        for function_ in ordered:
             parent = function_.get_parent()
-            if parent == root and boms:
-                value = function_.evaluate(function_.quantity,
-                    res, self)
+            if (function_.id in previous_values
+                    and references[function_] is not None
+                    and not references[function_] & changed
+                    and not depends[function_] & recomputed):
+                value = previous_values[function_.id]
             else:
-                value = function_.evaluate(function_.quantity,
-                    res[parent], self)
+                recomputed.add(function_)
+                if parent == root and boms:
+                    value = function_.evaluate(function_.quantity,
+                        res, self)
+                else:
+                    value = function_.evaluate(function_.quantity,
+                        res[parent], self)
+            if value is None or isinstance(value, (bool, int, float, Decimal,
+                        str)):
+                cached_values[function_.id] = value
             res[parent][function_] = value
             if boms:
                 code = function_.get_full_code()
                 res[code] = value
+        if self.id is not None and self.id >= 0:
+            self._function_values_cache.set(self.id, {
+                    'template': self.template.id,
+                    'inputs': inputs,
+                    'functions': cached_values,
+                    })
+        logger.debug('Design %s: %s of %s functions evaluated', self.id,
+            len(recomputed), len(ordered))
 
-        supplierIpnr = SupplierIPNR.search([])
-        ipnr = {}
-        for sup in supplierIpnr:
-            code = sup.product.code + '_' + sup.color.code + '_' + str(
-                sup.supplier.code)
-            ipnr[code] = sup.ipnr
-
-        res['ipnr'] = ipnr
+        res['ipnr'] = dict(SupplierIPNR.get_lookup())
         suppliers = dict((x.category, x.supplier) for x in self.suppliers)
         res['suppliers'] = suppliers
 
         return res
 
+    def get_function_dependencies(self, functions, attributes, boms):
+        '''
+        Return the functions and the attributes each function formula
+        references.
+
+        attributes maps (scope, name) to the attribute property id, where the
+        scope is the parent BoM or None for the root scope. The referenced
+        attributes are None when the formula also reads other values, like
+        IPNR or suppliers.
+        '''
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        root = self.template
+        index = dict((f, i) for i, f in enumerate(functions))
+
+        # Names that resolve to a function in each evaluation scope: the root
+        # scope (None) sees every function by its full code while a BoM level
+        # only sees its own functions not shadowed by an attribute code.
+        scopes = {}
+        providers = defaultdict(lambda: defaultdict(list))
+        for function_ in functions:
+            parent = function_.get_parent()
+            scope = None if parent == root and boms else parent
+            scopes[function_] = scope
+            if boms:
+                providers[None][function_.get_full_code()].append(function_)
+            if scope is not None and (scope, function_.code) not in attributes:
+                providers[scope][function_.code].append(function_)
+
+        depends = {}
+        references = {}
+        for function_ in functions:
+            scope = scopes[function_]
+            available = providers[scope]
+            depend = set()
+            reference = set()
+            for name in Property.get_expression_names(function_.quantity):
+                if name in available:
+                    depend.update(available[name])
+                elif (scope, name) in attributes:
+                    reference.add(attributes[(scope, name)])
+                elif name != 'math' and name not in EVAL_FUNCTIONS:
+                    reference = None
+                    break
+            if function_.evaluate_2times:
+                # The name to look up is only known once evaluated
+                depend.update(f for fs in available.values() for f in fs
+                    if index[f] < index[function_])
+                reference = None
+            depend.discard(function_)
+            depends[function_] = depend
+            references[function_] = reference
+        return depends, references
+
+    def get_function_order(self, functions, properties, depends):
+        '''
+        Return the functions that have to be evaluated, each one after the
+        functions its formula references. The functions referencing each other
+        are evaluated by sequence.
+
+        When the prune_functions option of the product_dynamic_configurator
+        section is set, the functions not referenced, directly or through
+        other functions, by the formulas and templates of the other properties
+        are left out. Their values are then not available to the extensions.
+        '''
+        root = self.template
+        index = dict((f, i) for i, f in enumerate(functions))
+
+        names = None
+        if config_.config.getboolean('product_dynamic_configurator',
+                'prune_functions', default=False):
+            names = self.get_function_roots(properties)
+        if names is None:
+            reachable = set(functions)
+        else:
+            reachable = set()
+            pending = [f for f in functions
+                if f.code in names or f.get_full_code() in names]
+            while pending:
+                function_ = pending.pop()
+                if function_ not in reachable:
+                    reachable.add(function_)
+                    pending.extend(depends[function_])
+
+        remaining = {}
+        dependents = defaultdict(list)
+        for function_ in reachable:
+            remaining[function_] = len(depends[function_])
+            for depend in depends[function_]:
+                dependents[depend].append(function_)
+        ready = [index[f] for f in reachable if not remaining[f]]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            function_ = functions[heapq.heappop(ready)]
+            order.append(function_)
+            for dependent in dependents[function_]:
+                remaining[dependent] -= 1
+                if not remaining[dependent]:
+                    heapq.heappush(ready, index[dependent])
+        if len(order) < len(reachable):
+            cycle = sorted((f for f in reachable if remaining[f]),
+                key=index.get)
+            if names is not None:
+                raise UserError(gettext(
+                        'product_dynamic_configurator.msg_function_cycle',
+                        template=root.rec_name,
+                        functions=', '.join(f.rec_name for f in cycle)))
+            # As before the ordering, the functions are evaluated by sequence
+            logger.warning('Functions of template %s evaluated by sequence '
+                'as they reference each other: %s', root.rec_name,
+                ', '.join(f.rec_name for f in cycle))
+            order.extend(cycle)
+        return order
+
+    def get_function_roots(self, properties):
+        '''
+        Return the names referenced by the formulas and templates of the
+        properties that are not functions.
+
+        None means every function must be evaluated.
+        '''
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        JinjaTemplate = pool.get('configurator.jinja_template')
+        render_fields = {'code_jinja', 'name_jinja'}
+        render_fields.update(x for x, _ in self.get_design_render_fields())
+        render_fields.update(x for x, _ in self.get_product_render_fields())
+
+        names = set()
+        for prop in properties:
+            if prop.type != 'function':
+                if prop.evaluate_2times:
+                    return None
+                for expression in (prop.quantity, prop.bom_quantity,
+                        prop.product_attribute_value):
+                    names |= Property.get_expression_names(expression)
+                if prop.object_expression:
+                    for expression in literal_eval(
+                            prop.object_expression).values():
+                        names |= Property.get_expression_names(expression)
+            for field in render_fields:
+                source = getattr(prop, field, None)
+                if isinstance(source, JinjaTemplate):
+                    source = source.full_content
+                if isinstance(source, str):
+                    names |= Property.get_template_names(source)
+        if 'tree' in names:
+            # Templates can reach any function value through the tree
+            return None
+        return names
+
+    def get_evaluation_context(self, values, full):
+        '''
+        Return the evaluation context of values over full.
+
+        The context is built once per pricing or process run and reused by
+        every property evaluated against the same values.
+        '''
+        contexts = getattr(self, '_evaluation_contexts', None)
+        if contexts is None:
+            contexts = self._evaluation_contexts = {}
+        key = (id(values), id(full))
+        if key not in contexts:
+            context = EvaluationContext(self, full)
+            context.update(values)
+            # Keep values and full referenced so their ids are not reused
+            contexts[key] = (values, full, context)
+        return contexts[key][-1]
+
+    def prefetch_products(self, full):
+        '''
+        Search at once the existing products of the codes rendered by the BOM
+        and purchase product properties of the template.
+
+        The rendered codes are kept for the run. The properties whose code
+        does not render are skipped, as the run may not reach them.
+        '''
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        Product = pool.get('product.product')
+
+        codes = set()
+        rendered = {}
+        self._property_codes = (None, {})
+        properties = Property.search([
+                ('parent', 'child_of', [self.template.id]),
+                ('type', 'in', ['bom', 'purchase_product']),
+                ])
+        for prop in properties:
+            try:
+                code = prop.get_property_code(self, full)
+            except Exception:
+                continue
+            rendered[prop.id] = code
+            if code:
+                codes.add(code)
+        self._property_codes = (full, rendered)
+        products = self._existing_products = {c: [] for c in codes}
+        if codes:
+            for product in Product.search([
+                        ('template.code', 'in', list(codes)),
+                        ]):
+                products[product.template.code].append(product)
+
+    def get_existing_products(self, code):
+        "Return the products whose template code is code"
+        Product = Pool().get('product.product')
+        products = getattr(self, '_existing_products', None)
+        if products is not None and code in products:
+            return products[code]
+        return Product.search([
+                ('template.code', '=', code),
+                ])
+
+    def get_design_attribute(self, property):
+        '''
+        Return the attribute of the design for property or None.
+
+        The attributes are indexed by property once per pricing or process
+        run.
+        '''
+        index = getattr(self, '_attribute_index', None)
+        if index is None:
+            index = self._attribute_index = {}
+            # Only the stored attributes were found by searching them
+            if self.id is not None and self.id >= 0:
+                for attribute in self.attributes:
+                    index.setdefault(attribute.property.id, attribute)
+        return index.get(property.id)
+
     def create_object(self, object):
         pool = Pool()
         CreatedObject = pool.get('configurator.object')
@@ -1525,6 +2485,63 @@ class Design(Workflow, ModelSQL, ModelView):
         created.design = self
         return created
 
+    def save_objects(self, res):
+        '''
+        Save the records created by process for the design and link them to
+        it.
+
+        The records are saved in bulk by model in the order of
+        _save_objects_order, the models not listed being saved after them.
+        Return the (property, product) of the generated products.
+        '''
+        pool = Pool()
+        CreatedObject = pool.get('configurator.object')
+
+        def unique(records):
+            return list({id(r): r for r in records}.values())
+
+        products = []
+        to_save = defaultdict(list)
+        for prop, (obj, additional) in res.items():
+            generated = []
+            if prop.type == 'bom':
+                to_save[obj.__name__].append(obj)
+                generated = [o.product for o in obj.outputs]
+            if prop.type == 'purchase_product':
+                generated = [obj.product]
+            for product in generated:
+                products.append((prop, product))
+                if prop.parent is None:
+                    self.product = product
+            for obj in additional:
+                to_save[obj.__name__].append(obj)
+        to_save['product.template'][:0] = [p.template for _, p in products]
+        to_save['product.product'][:0] = [p for _, p in products]
+
+        order = self._save_objects_order()
+        for name in sorted(to_save, key=lambda n: (
+                    order.index(n) if n in order else len(order), n)):
+            pool.get(name).save(unique(to_save[name]))
+
+        refs = []
+        for prop, (obj, additional) in res.items():
+            if prop.type == 'bom':
+                refs.append(self.create_object(obj))
+                refs += [self.create_object(x) for x in obj.inputs]
+                refs += [self.create_object(x) for x in obj.outputs]
+            refs += [self.create_object(x) for x in additional]
+        CreatedObject.save(refs)
+        self.save()
+        return products
+
+    @staticmethod
+    def _save_objects_order():
+        "Return the models saved by save_objects, each after its references"
+        return ['product.template', 'product.product',
+            'purchase.product_supplier', 'purchase.product_supplier.price',
+            'production.route', 'production.bom', 'production.bom.input',
+            'production.bom.output', 'product.product-production.bom']
+
     def get_attributes(self):
         values = {}
         if not self.template:
@@ -1555,132 +2572,319 @@ class Design(Workflow, ModelSQL, ModelView):
     def custom_operations(self, res):
         pass
 
+    def reconcile_lines(self, lines):
+        '''
+        Replace the design lines of the quotations by the computed lines.
+
+        lines is a dictionary of design lines by (category or property,
+        quotation). The existing lines with the same key are updated only on
+        the changed fields so they keep their identity and manual unit price.
+        Return the number of created, updated and deleted lines.
+        '''
+        pool = Pool()
+        DesignLine = pool.get('configurator.design.line')
+
+        existing = {}
+        to_delete = []
+        for quote in self.prices:
+            for line in quote.prices:
+                key = (line.category or line.property, quote)
+                if key[0] is None or key in existing:
+                    to_delete.append(line)
+                else:
+                    existing[key] = line
+
+        to_create, to_write = [], []
+        for key, dl in lines.items():
+            line = existing.pop(key, None)
+            if line is None:
+                to_create.append(dl)
+                continue
+            changed = False
+            for name in self._reconcile_line_fields():
+                value = getattr(dl, name, None)
+                if getattr(line, name) != value:
+                    setattr(line, name, value)
+                    changed = True
+            if changed:
+                to_write.append(line)
+        to_delete.extend(existing.values())
+
+        DesignLine.delete(to_delete)
+        DesignLine.save(to_write + to_create)
+        logger.debug('Design %s lines: %s created, %s updated, %s deleted, '
+            '%s unchanged', self.id, len(to_create), len(to_write),
+            len(to_delete), len(lines) - len(to_create) - len(to_write))
+        return len(to_create), len(to_write), len(to_delete)
+
+    @staticmethod
+    def _reconcile_line_fields():
+        return ['quantity', 'uom', 'unit_price', 'qty_ratio',
+            'debug_quantity']
+
+    def get_price_lines(self, context):
+        '''
+        Compute the design lines of the quotations.
+
+        Return the lines keyed by (category or property, quotation) and the
+        codes of the products priced.
+        '''
+        pool = Pool()
+        QuotationLine = pool.get('configurator.quotation.line')
+        BomInput = pool.get('production.bom.input')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        prices = {}
+        values = self.as_dict()
+        full = self.design_full_dict()
+        self.prefetch_products(full)
+        with Transaction().set_context(context):
+            res = self.template.create_prices(self, values, full)
+        self.custom_operations(res)
+        suppliers = dict((x.category, x.supplier)
+            for x in self.suppliers)
+        product_codes = []
+        rows = []
+        if self.prices:
+            bom_quantity = Uom.compute_qty(self.template.uom,
+                self.template.evaluate(
+                    self.template.quantity, values, self),
+                self.template.uom,
+                round=False)
+            results = res.items()
+        else:
+            results = []
+
+        # Collect the quantity to price of each property once, the quotes
+        # only scale it by their own ratio
+        for prop, v in results:
+            v = v[0]
+            if prop.hidden:
+                continue
+            if isinstance(v, PricedItem):
+                code = '%s - %s' % (v.code, v.name)
+                if code not in product_codes:
+                    product_codes += [code]
+
+            if prop.type not in ('product', 'match'):
+                continue
+            if isinstance(v, BomInput):
+                rows.append((prop, v.quantity or 0, v.product))
+            elif isinstance(v, Product):
+                parent = prop.get_parent()
+                quantity = prop.evaluate(prop.quantity,
+                    values[parent], self)
+                rows.append((prop, quantity, v))
+
+        qty_ratios = {}
+        priced = []
+        for quote in self.prices:
+            quote_quantity = Uom.compute_qty(self.quotation_uom,
+                quote.quantity, self.template.uom, round=False)
+            quote_ratio = quote_quantity / bom_quantity
+            for prop, quantity, product in rows:
+                quantity = quantity * quote_ratio
+                if quantity == 0:
+                    continue
+                if prop not in qty_ratios:
+                    parent = prop.get_parent()
+                    with Transaction().set_context(context):
+                        qty_ratios[prop] = prop.get_price_ratio(
+                            values.get(parent, {}), self)
+                supplier = None
+                if prop.quotation_category:
+                    supplier = suppliers.get(prop.quotation_category)
+                priced.append((quote, prop, quantity, product, supplier))
+
+        # Resolve at once the purchase prices of the first product of each
+        # line, the merged ones are not priced
+        requests, keys = [], set()
+        for quote, prop, quantity, product, supplier in priced:
+            key = (prop.price_category or prop, quote)
+            if product and key not in keys:
+                keys.add(key)
+                requests.append((quote, product, quantity * qty_ratios[prop],
+                        prop.uom, supplier))
+        unit_prices = QuotationLine.get_unit_prices(requests)
+
+        for quote, prop, quantity, product, supplier in priced:
+            key = (prop.price_category or prop, quote)
+            cost_price = None
+            qty_ratio = qty_ratios[prop]
+            dl = prices.get(key)
+            if not dl:
+                if not product:
+                    continue
+                request = (quote, product, quantity * qty_ratio, prop.uom,
+                    supplier)
+                if request not in unit_prices:
+                    # The first product of the line had no price
+                    unit_prices.update(QuotationLine.get_unit_prices(
+                            [request]))
+                cost_price = unit_prices[request]
+                dl = prop.create_design_line(quantity * qty_ratio,
+                    prop.uom, cost_price, quote)
+                dl.qty_ratio = qty_ratio
+                dl.debug_quantity = quantity
+                if prop.price_category:
+                    dl.category = prop.price_category
+                else:
+                    dl.property = prop
+                if cost_price == 0:
+                    continue
+                prices[key] = dl
+            else:
+                cost_price = (Decimal(qty_ratio * quantity) / (
+                        dl.unit_price
+                        + Decimal(qty_ratio * quantity) * cost_price))
+                cost_price = Decimal(cost_price).quantize(Decimal(
+                    str(10.0 ** -price_digits[1])))
+                dl.quantity += quantity * qty_ratio
+                dl.debug_quantity = quantity
+                dl.unit_price = cost_price
+        return prices, product_codes
+
+    def get_prices_fingerprint(self):
+        '''
+        Return the key of the design lines computed for the design.
+
+        It covers the stored fields of the design the formulas can read, the
+        attribute values, the suppliers, the quotation quantities and the
+        price date. The changes of the template properties, the purchased
+        products, the IPNR and the supplier prices clear the cached lines
+        instead.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        exclude = {'id', 'create_uid', 'create_date', 'write_uid',
+            'write_date'} | set(self._prices_fingerprint_exclude())
+        values = []
+        for name, field in sorted(self._fields.items()):
+            if name in exclude or isinstance(field, (fields.Function,
+                        fields.One2Many, fields.Many2Many)):
+                continue
+            value = getattr(self, name, None)
+            if isinstance(value, Model):
+                value = value.id
+            values.append((name, value))
+        today = Date.today()
+        price_date = today
+        if self.design_date:
+            price_date = min(self.design_date, today)
+        attributes = sorted(repr((a.property.id,
+                    a.option.id if a.option else None, a.number, a.text,
+                    bool(a.use_property))) for a in self.attributes)
+        suppliers = sorted(repr((s.category and s.category.id,
+                    s.supplier and s.supplier.id)) for s in self.suppliers)
+        key = (tuple(values), tuple(attributes), tuple(suppliers),
+            tuple(sorted(q.quantity for q in self.prices)),
+            price_date.isoformat(), Transaction().language)
+        return hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _prices_fingerprint_exclude(cls):
+        "Return the fields written by create_prices itself"
+        return ['code', 'name', 'product_codes', 'quotation_date',
+            'quoted_by', 'requote_state', 'requote_date', 'requote_error']
+
+    def get_cached_price_lines(self, fingerprint):
+        '''
+        Return the design lines and product codes cached for the fingerprint
+        or None.
+        '''
+        pool = Pool()
+        DesignLine = pool.get('configurator.design.line')
+        Property = pool.get('configurator.property')
+        PriceCategory = pool.get('configurator.property.price_category')
+        Uom = pool.get('product.uom')
+
+        cached = self._prices_cache.get(fingerprint)
+        if cached is None:
+            return
+        lines, product_codes = cached
+        quotes = sorted(self.prices, key=lambda q: q.quantity)
+        prices = {}
+        for (index, property, category, quantity, uom, unit_price, qty_ratio,
+                debug_quantity) in lines:
+            dl = DesignLine()
+            dl.quotation = quotes[index]
+            dl.quantity = quantity
+            dl.uom = Uom(uom) if uom is not None else None
+            dl.unit_price = unit_price
+            dl.qty_ratio = qty_ratio
+            dl.debug_quantity = debug_quantity
+            if category is not None:
+                dl.category = PriceCategory(category)
+            else:
+                dl.property = Property(property)
+            prices[(dl.category if category is not None else dl.property,
+                    dl.quotation)] = dl
+        return prices, list(product_codes)
+
+    def set_cached_price_lines(self, fingerprint, prices, product_codes):
+        quotes = sorted(self.prices, key=lambda q: q.quantity)
+        index = {q: i for i, q in enumerate(quotes)}
+        lines = []
+        for dl in prices.values():
+            category = getattr(dl, 'category', None)
+            property = getattr(dl, 'property', None)
+            lines.append((index[dl.quotation],
+                    property.id if property else None,
+                    category.id if category else None,
+                    dl.quantity, dl.uom.id if dl.uom else None,
+                    dl.unit_price, dl.qty_ratio, dl.debug_quantity))
+        self._prices_cache.set(fingerprint,
+            (tuple(lines), tuple(product_codes)))
+
+    @classmethod
+    def clear_prices_cache(cls):
+        cls._prices_cache.clear()
+
     @classmethod
     @ModelView.button
     def create_prices(cls, designs):
         pool = Pool()
         User = pool.get('res.user')
         DesignLine = pool.get('configurator.design.line')
-        Lang = pool.get('ir.lang')
-        remove_lines = []
-        BomInput = pool.get('production.bom.input')
-        Product = pool.get('product.product')
-        Uom = pool.get('product.uom')
         Date = Pool().get('ir.date')
-        to_save = []
+        rendered = []
 
         context = Transaction().context.copy()
         context['prices']  = True
+        use_cache = config_.config.getboolean('product_dynamic_configurator',
+            'prices_cache', default=False)
 
         for design in designs:
             if not design.attributes:
                 continue
 
-            prices = {}
-            remove_lines = []
-            for price in design.prices:
-                remove_lines += price.prices
-            product_codes = []
+            design._evaluation_contexts = {}
+            design._attribute_index = None
+            design._price_ratios = {}
             design.quotation_date = Date.today()
             design.quoted_by = User(Transaction().user).employee
             design.product_codes = ''
 
-            values = design.as_dict()
-            full = design.design_full_dict()
-            with Transaction().set_context(context):
-                res = design.template.create_prices(design, values, full)
-            design.custom_operations(res)
-            suppliers = dict((x.category, x.supplier)
-                for x in design.suppliers)
-            product_codes = []
-            for quote in design.prices:
-                quote_quantity = Uom.compute_qty(design.quotation_uom,
-                    quote.quantity, design.template.uom, round=False)
-                bom_quantity = Uom.compute_qty(design.template.uom,
-                    design.template.evaluate(
-                        design.template.quantity, values, design),
-                    design.template.uom,
-                    round=False)
-                quote_ratio = quote_quantity / bom_quantity
-                for prop, v in res.items():
-                    v = v[0]
-                    key = (prop.price_category or prop.id, quote)
-
-                    dl = prices.get(key)
-                    quantity = 0
-                    cost_price = None
-                    product = None
-                    if prop.hidden:
-                        continue
-                    if prop.type == 'bom':
-                        for output in v.outputs:
-                            code = '%s - %s' % (
-                                output.product.template.code,
-                                output.product.template.name)
-                            if code not in product_codes:
-                                product_codes += [code]
-
-                    if prop.type == 'purchase_product':
-                        code = '%s - %s' % (
-                            v.product.template.code,
-                            v.product.template.name)
-                        if code not in product_codes:
-                            product_codes += [code]
-
-                    if prop.type not in ('product', 'match'):
-                        continue
-                    if prop.type in ('product', 'match'):
-                        if isinstance(v, BomInput):
-                            quantity = (v.quantity or 0) * quote_ratio
-                            product = v.product
-                        elif isinstance(v, Product):
-                            parent = prop.get_parent()
-                            quantity = prop.evaluate(prop.quantity,
-                                values[parent], design)
-                            quantity = quantity * quote_ratio
-                            product = v
-                    dl = prices.get(key)
-                    if quantity == 0:
-                        continue
-                    if not dl:
-                        supplier = None
-                        if prop.quotation_category:
-                            supplier = suppliers.get(prop.quotation_category)
-                        parent = prop.get_parent()
-                        with Transaction().set_context(context):
-                            qty_ratio = prop.get_ratio_for_prices(
-                                values.get(parent, {}), 1, design)
-
-                        if not product:
-                            continue
-                        cost_price = quote.get_unit_price(product,
-                            quantity * qty_ratio, prop.uom, supplier)
-                        dl = prop.create_design_line(quantity * qty_ratio,
-                            prop.uom, cost_price, quote)
-                        dl.qty_ratio = qty_ratio
-                        dl.debug_quantity = quantity
-                        if not prop.price_category:
-                            dl.property = prop
-                        if cost_price == 0:
-                            continue
-                        prices[key] = dl
-                    else:
-                        parent = prop.get_parent()
-                        with Transaction().set_context(context):
-                            qty_ratio = prop.get_ratio_for_prices(
-                                values.get(parent, {}), 1, design)
-                        cost_price = (Decimal(qty_ratio * quantity) / (
-                                dl.unit_price
-                                + Decimal(qty_ratio * quantity) * cost_price))
-                        cost_price = Decimal(cost_price).quantize(Decimal(
-                            str(10.0 ** -price_digits[1])))
-                        dl.quantity += quantity * qty_ratio
-                        dl.debug_quantity = quantity
-                        dl.unit_price = cost_price
-
-            DesignLine.delete(remove_lines)
-            to_save = prices.values()
-            DesignLine.save(to_save)
+            fingerprint = cached = None
+            if use_cache:
+                fingerprint = design.get_prices_fingerprint()
+                cached = design.get_cached_price_lines(fingerprint)
+            if cached is not None:
+                prices, product_codes = cached
+            else:
+                prices, product_codes = design.get_price_lines(context)
+                if use_cache:
+                    design.set_cached_price_lines(
+                        fingerprint, prices, product_codes)
+
+            if config_.config.getboolean('product_dynamic_configurator',
+                    'reconcile_lines', default=True):
+                design.reconcile_lines(prices)
+            else:
+                DesignLine.delete([line for quote in design.prices
+                        for line in quote.prices])
+                DesignLine.save(prices.values())
 
             custom_locals = design.design_full_dict()
             code = design.render_field(design.template, 'code_jinja',
@@ -1688,15 +2892,94 @@ class Design(Workflow, ModelSQL, ModelView):
             design.code = code
             design.product_codes = "\n".join(product_codes)
             design.save()
+            rendered.append(design)
+
+        cls.render_designs_fields(rendered)
+
+    @classmethod
+    def requote(cls, designs):
+        '''
+        Queue the re-quote of the draft designs with quotations.
+
+        The designs are split in chunks of the queue batch size and each chunk
+        is priced by a queue worker in its own transaction.
+        '''
+        designs = [d for d in designs if d.state == 'draft' and d.prices]
+        if not designs:
+            return
+        cls.write(designs, {
+                'requote_state': 'queued',
+                'requote_error': None,
+                })
+        with Transaction().set_context(queue_batch=True):
+            cls.__queue__.requote_chunk(designs)
 
-            langs = Lang.search([('active', '=', True),
-                ('translatable', '=', True)])
-            for lang in langs:
-                design.render_design_fields(lang)
+    @classmethod
+    def requote_chunk(cls, designs):
+        "Create the prices of designs recording the result of each one"
+        transaction = Transaction()
+        for design in designs:
+            # Each design is priced in its own transaction so a failure does
+            # not roll back the rest of the chunk
+            try:
+                with transaction.new_transaction():
+                    design = cls(design.id)
+                    if design.state != 'draft':
+                        # The design left the draft state since it was queued
+                        cls.write([design], {'requote_state': None})
+                        continue
+                    cls.create_prices([design])
+                    cls.write([design], {
+                            'requote_state': 'done',
+                            'requote_date': datetime.datetime.now(),
+                            'requote_error': None,
+                            })
+            except Exception:
+                logger.warning('Re-quote of design %s failed', design.id,
+                    exc_info=True)
+                with transaction.new_transaction():
+                    cls.write([cls(design.id)], {
+                            'requote_state': 'failed',
+                            'requote_date': datetime.datetime.now(),
+                            'requote_error': traceback.format_exc(),
+                            })
 
+    @classmethod
+    def requote_drafts(cls):
+        "Queue the re-quote of every draft design with quotations"
+        cls.requote(cls.search([
+                    ('state', '=', 'draft'),
+                    ('prices', '!=', None),
+                    ]))
 
     def design_full_dict(self):
+        '''
+        Return the names available to the Jinja templates of the design.
+
+        The result is reused for the rest of the transaction until the
+        attributes or the suppliers of the design are modified.
+        '''
+        cls = self.__class__
+        # Unsaved values (as the ones of the on_change) are never reused
+        if (self.id is None or self.id < 0 or (self._values
+                    and {'template', 'attributes', 'suppliers'}
+                    & set(self._values._keys()))):
+            return self._design_full_dict()
+        transaction = Transaction()
+        full_dicts = cls._full_dicts.setdefault(transaction, {})
+        key = (self.id, transaction.language)
+        if key in full_dicts:
+            cls._full_dict_hits += 1
+        else:
+            cls._full_dict_misses += 1
+            full_dicts[key] = self._design_full_dict()
+        logger.debug('Design full dict: %s rebuilds avoided, %s built',
+            cls._full_dict_hits, cls._full_dict_misses)
+        custom_locals = OrderedDict(full_dicts[key])
+        custom_locals['design'] = self
+        return custom_locals
 
+    def _design_full_dict(self):
         record = self.as_dict()
         custom_locals = OrderedDict()
         all = {}
@@ -1707,9 +2990,7 @@ class Design(Workflow, ModelSQL, ModelView):
         properties = Property.search([
             ('parent', 'child_of', [self.template.id])], order=[('sequence','ASC')])
         custom_locals['design'] = self
-        properties.sort(key=lambda x: (
-            str(x.parent and x.parent.sequence or 0).zfill(5) +
-                str(x.sequence).zfill(6)))
+        properties.sort(key=property_sequence)
 
 
         boms_dict = {}
@@ -1781,60 +3062,103 @@ class Design(Workflow, ModelSQL, ModelView):
     def get_design_render_fields(self):
         return [('name_jinja', 'name')]
 
+    @staticmethod
+    def get_render_languages():
+        pool = Pool()
+        Lang = pool.get('ir.lang')
+        return Lang.search([
+                ('active', '=', True),
+                ('translatable', '=', True),
+                ])
+
     def render_design_fields(self, lang):
+        self.render_designs_fields([self], langs=[lang])
+
+    @classmethod
+    def render_designs_fields(cls, designs, langs=None):
+        '''
+        Render the design fields of the designs in the translatable languages.
+
+        The designs are read once per language and saved with a single call.
+        '''
+        if not designs:
+            return
+        if langs is None:
+            langs = cls.get_render_languages()
+        ids = [d.id for d in designs]
+        for lang in langs:
+            with Transaction().set_context(language=lang.code):
+                designs = cls.browse(ids)
+                for design in designs:
+                    design.set_design_fields(design.design_full_dict())
+                cls.save(designs)
+
+    def set_design_fields(self, custom_locals):
         pool = Pool()
-        Design = pool.get('configurator.design')
         JinjaField = pool.get('configurator.jinja_template')
-        design_fields = self.get_design_render_fields()
+        ptemplate = self.template
+        for tmpl_field, field in self.get_design_render_fields():
+            f = getattr(ptemplate, tmpl_field)
+            # in case has not value, set field to None
+            if not f or f is None or f == '':
+                val = None
+            else:
+                if isinstance(f, JinjaField):
+                    f = f.full_content
+                val = ptemplate.render_expression_record(f, custom_locals)
+                val = val.replace('\n', '').replace('\t', '')
+            setattr(self, field, val)
 
-        with Transaction().set_context(language=lang.code):
-            design = Design(self.id)
-            custom_locals = design.design_full_dict()
-            ptemplate = design.template
-            for tmpl_field, field in design_fields:
-                f = getattr(ptemplate, tmpl_field)
-                # in case has not value, set field to None
-                if not f or f is None or f == '':
-                    val = None
-                else:
-                    if isinstance(f, JinjaField):
-                        f = f.full_content
-                    val = ptemplate.render_expression_record(f, custom_locals)
-                    val = val.replace('\n', '').replace('\t', '')
-                setattr(design, field, val)
-            design.save()
+    def render_product_fields(self, lang, product, pproperty=None, full=None):
+        self.render_products_fields([(pproperty, product)], langs=[lang])
 
+    def render_products_fields(self, products, langs=None):
+        '''
+        Render the product fields of the (property, product) pairs in the
+        translatable languages.
 
-    def render_product_fields(self, lang, product, pproperty=None, full=None):
+        The design context is built once per language, as it holds translated
+        values, and the templates and products are saved with a single call
+        per language.
+        '''
         pool = Pool()
         Design = pool.get('configurator.design')
+        Template = pool.get('product.template')
         Product = pool.get('product.product')
-        product_fields = self.get_product_render_fields()
-
-        with Transaction().set_context(language=lang.code):
-            design = Design(self.id)
-            product = Product(product.id)
-            custom_locals = design.design_full_dict()
-
-            template = product.template
-            property = pproperty or design.template
-            for tmpl_field, field in product_fields:
-                val = ''
-                if tmpl_field == 'name' and pproperty:
-                    parent = pproperty.get_parent()
-                    if parent and parent != pproperty:
-                        val = (self.render_field(parent, tmpl_field,
-                            custom_locals) or '').strip()
-
-                val = val + (self.render_field(property, tmpl_field,
-                    custom_locals) or '').strip()
-                if val:
-                    if tmpl_field != 'name':
-                        setattr(product, field, val)
-                    else:
-                        setattr(template, field, val)
-            template.save()
-            product.save()
+        if not products:
+            return
+        if langs is None:
+            langs = self.get_render_languages()
+        for lang in langs:
+            with Transaction().set_context(language=lang.code):
+                design = Design(self.id)
+                custom_locals = design.design_full_dict()
+                records = Product.browse([p.id for _, p in products])
+                for (pproperty, _), product in zip(products, records):
+                    design.set_product_fields(product, pproperty,
+                        custom_locals)
+                templates = {p.template.id: p.template for p in records}
+                Template.save(list(templates.values()))
+                Product.save(records)
+
+    def set_product_fields(self, product, pproperty, custom_locals):
+        template = product.template
+        property = pproperty or self.template
+        for tmpl_field, field in self.get_product_render_fields():
+            val = ''
+            if tmpl_field == 'name' and pproperty:
+                parent = pproperty.get_parent()
+                if parent and parent != pproperty:
+                    val = (self.render_field(parent, tmpl_field,
+                        custom_locals) or '').strip()
+
+            val = val + (self.render_field(property, tmpl_field,
+                custom_locals) or '').strip()
+            if val:
+                if tmpl_field != 'name':
+                    setattr(product, field, val)
+                else:
+                    setattr(template, field, val)
 
     def render_field(self, property, field, custom_locals):
         pool = Pool()
@@ -1856,57 +3180,21 @@ class Design(Workflow, ModelSQL, ModelView):
     def process(cls, designs):
         pool = Pool()
         CreatedObject = pool.get('configurator.object')
-        Lang = pool.get('ir.lang')
-        langs = Lang.search([('active', '=', True),
-            ('translatable', '=', True)])
+        langs = cls.get_render_languages()
         to_delete = []
         for design in designs:
+            design._evaluation_contexts = {}
+            design._attribute_index = None
+            design._price_ratios = {}
             custom_locals = design.design_full_dict()
             design.code = design.render_field(design.template, 'code_jinja',
                 custom_locals)
             to_delete += [x for x in design.objects]
+            design.prefetch_products(custom_locals)
             with Transaction().set_context(update=True):
                 res = design.template.create_prices(design, design.as_dict(), custom_locals)
-            for prop, objs in res.items():
-                obj, additional = objs
-                if prop.type == 'bom':
-                    obj.save()
-                    ref = design.create_object(obj)
-                    ref.save()
-                    for input_ in obj.inputs:
-                        ref = design.create_object(input_)
-                        ref.save()
-                    for output_ in obj.outputs:
-                        ref = design.create_object(output_)
-                        ref.save()
-                        product = output_.product
-                        template = product.template
-                        template.save()
-                        product.save()
-                        if prop.parent is None:
-                            design.product = product
-                            design.save()
-                        for lang in langs:
-                            design.render_product_fields(lang, product, prop,
-                                full= custom_locals)
-
-                if prop.type == 'purchase_product':
-                    product = obj.product
-                    template = product.template
-                    template.save()
-                    product.save()
-                    if prop.parent is None:
-                        design.product = product
-                        design.save()
-                    for lang in langs:
-                        design.render_product_fields(lang, product, prop,
-                            full=custom_locals)
-
-                for obj in additional:
-                    obj.save()
-                    ref = design.create_object(obj)
-                    if ref:
-                        ref.save()
+            products = design.save_objects(res)
+            design.render_products_fields(products, langs=langs)
 
             product = design.product
             template = product.template
@@ -1933,6 +3221,17 @@ class Design(Workflow, ModelSQL, ModelView):
         CreatedObject.delete(to_delete)
 
 
+class RequoteDesign(Wizard):
+    'Re-quote Design'
+    __name__ = 'configurator.design.requote'
+    start_state = 'requote'
+    requote = StateTransition()
+
+    def transition_requote(self):
+        self.model.requote(self.records)
+        return 'end'
+
+
 class QuotationSupplier(ModelSQL, ModelView):
     """ Quotation Supplier """
     __name__ = 'configurator.quotation.supplier'
@@ -1942,6 +3241,13 @@ class QuotationSupplier(ModelSQL, ModelView):
         'Category')
     supplier = fields.Many2One('party.party', 'Supplier')
 
+    @classmethod
+    def on_modification(cls, mode, suppliers, field_names=None):
+        pool = Pool()
+        Design = pool.get('configurator.design')
+        super().on_modification(mode, suppliers, field_names=field_names)
+        Design.clear_full_dict([s.design for s in suppliers if s.design])
+
 
 class QuotationLine(ModelSQL, ModelView):
     """  Quotation Line """
@@ -2029,10 +3335,7 @@ class QuotationLine(ModelSQL, ModelView):
             context['uom'] = uom and uom.id
         return context
 
-    def get_unit_price(self, product, quantity, uom, supplier):
-        pool = Pool()
-        Product = pool.get('product.product')
-
+    def _get_context_unit_price(self, product, uom, supplier):
         context = self._get_context_purchase_price()
         context.update(product.template.get_purchase_context())
         if supplier:
@@ -2041,13 +3344,55 @@ class QuotationLine(ModelSQL, ModelView):
             del context['supplier']
 
         context['uom'] = uom and uom.id
-        with Transaction().set_context(context):
-            unit_price = Product.get_purchase_price(
-                [product], abs(quantity or 0))[product.id]
-            if unit_price:
-                unit_price = unit_price.quantize(
-                    Decimal(1) / 10 ** price_digits[1])
-            return unit_price
+        return context
+
+    def get_unit_price(self, product, quantity, uom, supplier):
+        request = (self, product, quantity, uom, supplier)
+        return self.get_unit_prices([request])[request]
+
+    @staticmethod
+    def _get_unit_price_key(context):
+        context = context.copy()
+        key = tuple(context.pop(name, None)
+            for name in ['supplier', 'uom', 'purchase_date', 'currency'])
+        return key + tuple(sorted(context.items()))
+
+    @classmethod
+    def get_unit_prices(cls, requests):
+        '''
+        Return the unit prices of the (quote, product, quantity, uom, supplier)
+        requests.
+
+        The requests are grouped by supplier, uom, date, currency and quantity
+        and the products of each group are priced with a single call.
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        groups = {}
+        for request in requests:
+            quote, product, quantity, uom, supplier = request
+            context = quote._get_context_unit_price(product, uom, supplier)
+            quantity = abs(quantity or 0)
+            key = (cls._get_unit_price_key(context), quantity)
+            if key not in groups:
+                groups[key] = (context, quantity, [])
+            groups[key][-1].append(request)
+
+        unit_prices = {}
+        for context, quantity, group in groups.values():
+            products = list(dict.fromkeys(r[1] for r in group))
+            with Transaction().set_context(context):
+                prices = Product.get_purchase_price(products, quantity)
+            for request in group:
+                unit_price = prices[request[1].id]
+                if unit_price:
+                    unit_price = unit_price.quantize(
+                        Decimal(1) / 10 ** price_digits[1])
+                unit_prices[request] = unit_price
+        logger.debug('Unit prices: %s requests priced with %s lookups',
+            len(unit_prices), len(groups))
+        return unit_prices
 
     @classmethod
     def get_prices(cls, quotations, names):
@@ -2196,6 +3541,13 @@ class DesignAttribute(sequence_ordered(), ModelSQL, ModelView):
     design_state = fields.Function(fields.Selection(STATES, 'Design State'),
         'on_change_with_design_state')
 
+    @classmethod
+    def on_modification(cls, mode, attributes, field_names=None):
+        pool = Pool()
+        Design = pool.get('configurator.design')
+        super().on_modification(mode, attributes, field_names=field_names)
+        Design.clear_full_dict([a.design for a in attributes])
+
     @fields.depends('design', '_parent_design.state')
     def on_change_with_design_state(self, name=None):
         if self.design:
@@ -2213,3 +3565,13 @@ class DesignAttribute(sequence_ordered(), ModelSQL, ModelView):
             return []
         res = [x.id for x in self.property.childs]
         return res
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('configurator.design|requote_drafts', "Re-quote Draft Designs"))
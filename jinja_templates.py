@@ -1,11 +1,18 @@
+import hashlib
+import logging
+
+from trytond.cache import Cache
 from trytond.model import DeactivableMixin, ModelSQL, ModelView, fields
+from trytond.pool import Pool
 
 try:
-    from jinja2 import Template as Jinja2Template
+    from jinja2 import Environment as Jinja2Environment
+    from jinja2 import FunctionLoader
     jinja2_loaded = True
 except ImportError:
     jinja2_loaded = False
 
+logger = logging.getLogger(__name__)
 
 
 class JinjaTemplate(DeactivableMixin, ModelSQL, ModelView):
@@ -21,6 +28,8 @@ class JinjaTemplate(DeactivableMixin, ModelSQL, ModelView):
     jinja = fields.Text('Jinja Expression')
     full_content = fields.Function(fields.Text('Full Content'),
         'get_full_content')
+    _compiled_cache = Cache('configurator.jinja_template.compiled',
+        context=False)
 
     @classmethod
     def __setup__(cls):
@@ -28,13 +37,69 @@ class JinjaTemplate(DeactivableMixin, ModelSQL, ModelView):
         cls._order.insert(0, ('name', 'ASC'))
 
 
+    @classmethod
+    def on_modification(cls, mode, templates, field_names=None):
+        pool = Pool()
+        Design = pool.get('configurator.design')
+        super().on_modification(mode, templates, field_names=field_names)
+        cls._compiled_cache.clear()
+        Design.clear_prices_cache()
+
+    @classmethod
+    def get_environment(cls):
+        '''
+        Return the Jinja environment shared by the renders.
+
+        Macro templates are available by name to the import statements, so
+        they are compiled once and reused by every template importing them.
+        '''
+        # Compiled objects can not be copied by the cache so they are stored
+        # inside a tuple which is kept as is
+        cached = cls._compiled_cache.get('environment')
+        if cached is None:
+            environment = Jinja2Environment(trim_blocks=True,
+                loader=FunctionLoader(cls.load_macro))
+            cached = cls._compiled_cache.set('environment', (environment,))
+        environment, = cached
+        return environment
+
+    @classmethod
+    def load_macro(cls, name):
+        "Return the Jinja source of the macro template named name"
+        templates = cls.search([
+                ('name', '=', name),
+                ('type_', '=', 'macro'),
+                ], limit=1)
+        if templates:
+            template, = templates
+            return template.jinja or ''
+
+    @classmethod
+    def get_template(cls, source):
+        "Return the compiled Jinja template of source"
+        if not isinstance(source, str):
+            raise TypeError('Jinja template source must be a string')
+        key = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        cached = cls._compiled_cache.get(key)
+        if cached is None:
+            template = cls.get_environment().from_string(source)
+            cached = cls._compiled_cache.set(key, (template,))
+            cache = cls._compiled_cache
+            logger.debug('Jinja template cache: %s hits, %s misses (%.1f%%)',
+                cache.hit, cache.miss,
+                100.0 * cache.hit / ((cache.hit + cache.miss) or 1))
+        template, = cached
+        return template
+
     def get_full_content(self, name=None):
+        # Linked macros are still prepended to the template for the bases
+        # that do not import them
         text = [x.jinja for x in self.macros if x]
         text.append(self.jinja)
         return "\n".join(text)
 
     def render(self, record):
-        template = Jinja2Template(self.full_content, trim_blocks=True)
+        template = self.get_template(self.full_content)
         res = template.render(record)
         if res:
             res = res.replace('\t', '').replace('\n', '').strip()
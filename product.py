@@ -1,6 +1,6 @@
 import html
 from trytond.model import fields
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
 
 class Template(metaclass=PoolMeta):
@@ -13,11 +13,82 @@ class Template(metaclass=PoolMeta):
             ('category', '=', Eval('default_uom_category')),
             ])
 
+    @classmethod
+    def on_modification(cls, mode, templates, field_names=None):
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        Design = pool.get('configurator.design')
+        super().on_modification(mode, templates, field_names=field_names)
+        Property.clear_match_cache()
+        # Only the purchased products are priced, as were the products which
+        # are no longer purchased
+        if ((mode == 'write'
+                    and {'purchasable', 'type'} & set(field_names or []))
+                or any(t.purchasable or t.type == 'service'
+                    for t in templates)):
+            Design.clear_prices_cache()
+
 class Product(metaclass=PoolMeta):
     __name__ = 'product.product'
 
+    @classmethod
+    def on_modification(cls, mode, products, field_names=None):
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        Design = pool.get('configurator.design')
+        super().on_modification(mode, products, field_names=field_names)
+        Property.clear_match_cache()
+        # Only the purchased products are priced, as were the products which
+        # are no longer purchased
+        if ((mode == 'write'
+                    and {'purchasable', 'type'} & set(field_names or []))
+                or any(p.template.purchasable
+                    or p.template.type == 'service' for p in products)):
+            Design.clear_prices_cache()
+
     def get_rec_name(self, name):
         emoji = ''
         if not self.active:
             emoji = '🔴'
         return html.unescape(emoji) + " " + super(Product, self).get_rec_name(name)
+
+
+class ProductAttribute(metaclass=PoolMeta):
+    __name__ = 'product.product.attribute'
+
+    @classmethod
+    def on_modification(cls, mode, attributes, field_names=None):
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        Design = pool.get('configurator.design')
+        super().on_modification(mode, attributes, field_names=field_names)
+        Property.clear_match_cache()
+        # Only the attributes of the service products are matched
+        if any(a.product and a.product.template.type == 'service'
+                for a in attributes):
+            Design.clear_prices_cache()
+
+
+class ProductSupplier(metaclass=PoolMeta):
+    __name__ = 'purchase.product_supplier'
+
+    @classmethod
+    def on_modification(cls, mode, product_suppliers, field_names=None):
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        Design = pool.get('configurator.design')
+        super().on_modification(mode, product_suppliers,
+            field_names=field_names)
+        Property.clear_match_cache()
+        Design.clear_prices_cache()
+
+
+class ProductSupplierPrice(metaclass=PoolMeta):
+    __name__ = 'purchase.product_supplier.price'
+
+    @classmethod
+    def on_modification(cls, mode, prices, field_names=None):
+        pool = Pool()
+        Design = pool.get('configurator.design')
+        super().on_modification(mode, prices, field_names=field_names)
+        Design.clear_prices_cache()
@@ -2,13 +2,1086 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+import copy
+import pickle
+from contextlib import nullcontext
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import trytond.config as config_
+from trytond.exceptions import UserError
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.modules.product_dynamic_configurator.configurator import (
+    MatchIndex, PropertyNode, logger, price_digits)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
 
 
 class ProductDynamicConfiguratorTestCase(CompanyTestMixin, ModuleTestCase):
     'Test ProductDynamicConfigurator module'
     module = 'product_dynamic_configurator'
 
+    def test_property_node(self):
+        'Test property nodes are cacheable and follow inactive properties'
+        rows = [
+            {'id': 1, 'parent': None, 'code': 'T', 'type': 'bom',
+                'sequence': 1, 'active': True},
+            {'id': 2, 'parent': 1, 'code': 'G', 'type': 'group',
+                'sequence': 1, 'active': False},
+            {'id': 3, 'parent': 2, 'code': 'P', 'type': 'product',
+                'sequence': 1, 'active': True},
+            {'id': 4, 'parent': 2, 'code': 'Q', 'type': 'product',
+                'sequence': 2, 'active': False},
+            ]
+        nodes = PropertyNode.build(rows)
+
+        self.assertEqual(nodes[1].childrens, (3,))
+        self.assertEqual(nodes[3].bom, 1)
+        self.assertEqual(nodes[3].full_path, 'G_P')
+        node = nodes[3]
+        self.assertIs(copy.copy(node), node)
+        restored = pickle.loads(pickle.dumps(node))
+        for name in PropertyNode.__slots__:
+            self.assertEqual(getattr(restored, name), getattr(node, name))
+        with self.assertRaises(AttributeError):
+            node.code = 'X'
+
+    @with_transaction()
+    def test_property_child_of(self):
+        'Test the nested set of the properties against the parent links'
+        pool = Pool()
+        Property = pool.get('configurator.property')
+
+        root, = Property.create([{
+                    'code': 'root',
+                    'name': 'Root',
+                    'type': 'group',
+                    }])
+        parents = [root]
+        levels = []
+        for depth in range(4):
+            parents = Property.create([{
+                        'code': 'p%s_%s_%s' % (depth, parent.id, i),
+                        'name': 'Property',
+                        'type': 'group',
+                        'parent': parent.id,
+                        } for parent in parents for i in range(5)])
+            levels.append(parents)
+
+        def recursive(ids):
+            result = list(ids)
+            while ids:
+                ids = [p.id for p in Property.search([('parent', 'in', ids)])]
+                result += ids
+            return result
+
+        def nested(prop):
+            prop = Property(prop.id)
+            return [p.id for p in Property.search([
+                        ('left', '>=', prop.left),
+                        ('right', '<=', prop.right),
+                        ])]
+
+        def check(prop):
+            expected = sorted(recursive([prop.id]))
+            self.assertEqual(sorted(nested(prop)), expected)
+            self.assertEqual(sorted(p.id for p in Property.search([
+                            ('parent', 'child_of', [prop.id]),
+                            ])), expected)
+
+        new = [p.id for p in Property.search([
+                    ('parent', 'child_of', [root.id]),
+                    ])]
+        self.assertEqual(len(new), 1 + 5 + 25 + 125 + 625)
+        for prop in [root, levels[0][0], levels[1][7], levels[3][42]]:
+            check(prop)
+
+        # the nested set follows the moved subtrees
+        moved, target = levels[1][3], levels[2][60]
+        moved.parent = target
+        moved.save()
+        for prop in [root, levels[0][0], levels[1][7], target, moved]:
+            check(prop)
+
+        # the snapshot is stored in and served from the cache
+        for _ in range(2):
+            tree = Property.get_tree()
+            self.assertEqual(set(new) - set(tree), set())
+
+    @with_transaction()
+    def test_design_attribute_index(self):
+        'Test design attributes are looked up without searching them'
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        Design = pool.get('configurator.design')
+        DesignAttribute = pool.get('configurator.design.attribute')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Property.create([{
+                        'code': 'T',
+                        'name': 'Template',
+                        'type': 'group',
+                        'template': True,
+                        }])
+            options = Property.create([{
+                        'code': 'O%s' % i,
+                        'name': 'Options',
+                        'type': 'options',
+                        'user_input': True,
+                        'parent': template.id,
+                        } for i in range(10)])
+            choices = Property.create([{
+                        'code': '%s_A' % option.code,
+                        'name': 'Choice',
+                        'type': 'text',
+                        'parent': option.id,
+                        } for option in options])
+            design, = Design.create([{
+                        'template': template.id,
+                        'quotation_uom': unit.id,
+                        'sale_uom': unit.id,
+                        'attributes': [('create', [{
+                                        'property': option.id,
+                                        'option': choice.id,
+                                        } for option, choice in zip(
+                                        options, choices)])],
+                        }])
+
+            def search_attribute(design, property):
+                attributes = DesignAttribute.search([
+                        ('property', '=', property.id),
+                        ('design', '=', design.id),
+                        ])
+                return attributes[0] if attributes else None
+
+            expected = {o: search_attribute(design, o) for o in options}
+            self.assertEqual(
+                {o: a.option for o, a in expected.items()},
+                dict(zip(options, choices)))
+
+            def lookups():
+                "Return the attribute searches of the options nodes"
+                with patch.object(DesignAttribute, 'search',
+                        wraps=DesignAttribute.search) as search:
+                    for option, choice in zip(options, choices):
+                        self.assertEqual(
+                            option.get_options(design, {}, [], {}),
+                            {option: (None, [])})
+                        self.assertIsNone(
+                            choice.get_purchase_product(design, {}, [], {}))
+                    return search.call_count
+
+            with patch.object(Design, 'get_design_attribute',
+                    search_attribute):
+                self.assertEqual(lookups(), 2 * len(options))
+
+            # the attributes of the design are already loaded
+            design = Design(design.id)
+            self.assertEqual(len(design.attributes), len(options))
+            self.assertEqual(lookups(), 0)
+            for option in options:
+                self.assertEqual(
+                    design.get_design_attribute(option), expected[option])
+            self.assertEqual(design.get_design_attribute(template), None)
+
+    @with_transaction()
+    def test_design_save_objects(self):
+        'Test the created records are saved in bulk in dependency order'
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        Design = pool.get('configurator.design')
+        CreatedObject = pool.get('configurator.object')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Bom = pool.get('production.bom')
+        BomOutput = pool.get('production.bom.output')
+        ProductBom = pool.get('product.product-production.bom')
+        Route = pool.get('production.route')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            base, = Template.create([{
+                        'name': 'Base',
+                        'default_uom': unit.id,
+                        'configurator_template': True,
+                        'products': [('create', [{}])],
+                        }])
+            template, = Property.create([{
+                        'code': 'T',
+                        'name': 'Template',
+                        'type': 'group',
+                        'template': True,
+                        }])
+            boms = Property.create([{
+                        'code': 'B%s' % i,
+                        'name': 'BOM',
+                        'type': 'bom',
+                        'parent': template.id,
+                        'uom': unit.id,
+                        'quantity': '1',
+                        'bom_quantity': '1',
+                        'product_template': base.id,
+                        } for i in range(5)])
+            design, = Design.create([{
+                        'template': template.id,
+                        'quotation_uom': unit.id,
+                        'sale_uom': unit.id,
+                        }])
+
+            res = {}
+            for prop in boms:
+                product = Product(template=Template(
+                        name='Generated %s' % prop.code,
+                        default_uom=unit,
+                        list_price=Decimal(0)))
+                bom = Bom(
+                    name=prop.code,
+                    inputs=[],
+                    outputs=[BomOutput(
+                            product=product, unit=unit, quantity=1)],
+                    )
+                route = Route(name=prop.code, uom=unit, operations=[])
+                # the link is listed before the route it references
+                res[prop] = (bom, [
+                        ProductBom(product=product, bom=bom, route=route),
+                        route,
+                        ])
+
+            models = [Template, Product, Route, Bom, ProductBom, CreatedObject]
+            calls = []
+            mocks = []
+            for Model in models:
+                for method in ['create', 'write']:
+                    def record(*args, Model=Model, method=method,
+                            original=getattr(Model, method)):
+                        calls.append((method, Model.__name__))
+                        return original(*args)
+                    mocks.append(patch.object(Model, method,
+                            side_effect=record))
+            for mock in mocks:
+                mock.start()
+            try:
+                products = design.save_objects(res)
+            finally:
+                for mock in mocks:
+                    mock.stop()
+
+            # one create by model, each after the models it references
+            self.assertEqual(
+                calls, [('create', M.__name__) for M in models])
+            self.assertEqual(len(products), len(boms))
+            self.assertTrue(all(p.id >= 0 for _, p in products))
+            for prop, product in products:
+                bom, (product_bom, route) = res[prop]
+                self.assertEqual(product_bom.product, product)
+                self.assertEqual(product_bom.bom, bom)
+                self.assertEqual(product_bom.route, route)
+            self.assertEqual(CreatedObject.search([
+                        ('design', '=', design.id),
+                        ], count=True), 4 * len(boms))
+
+    @with_transaction()
+    def test_design_reconcile_lines(self):
+        'Test design lines are updated in place on re-quote'
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        Design = pool.get('configurator.design')
+        DesignLine = pool.get('configurator.design.line')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Property.create([{
+                        'code': 'T',
+                        'name': 'Template',
+                        'type': 'group',
+                        'template': True,
+                        }])
+            props = Property.create([{
+                        'code': 'P%s' % i,
+                        'name': 'Product',
+                        'type': 'group',
+                        'parent': template.id,
+                        } for i in range(4)])
+            design, = Design.create([{
+                        'template': template.id,
+                        'quotation_uom': unit.id,
+                        'sale_uom': unit.id,
+                        'prices': [('create', [{'quantity': 10}])],
+                        }])
+            quote, = design.prices
+
+            def compute(props, quantity):
+                lines = {}
+                for prop in props:
+                    line = prop.create_design_line(
+                        quantity, unit, Decimal('1.5'), quote)
+                    line.property = prop
+                    line.qty_ratio = 1
+                    line.debug_quantity = quantity
+                    lines[(prop, quote)] = line
+                return lines
+
+            lines = compute(props[:3], 2)
+            self.assertEqual(design.reconcile_lines(lines), (3, 0, 0))
+            kept, changed, removed = DesignLine.search([
+                    ('quotation', '=', quote.id),
+                    ], order=[('property', 'ASC')])
+            kept.manual_unit_price = Decimal('3')
+            kept.save()
+
+            lines = compute(props[:1], 2)
+            lines.update(compute(props[1:2], 4))
+            lines.update(compute(props[3:], 2))
+            design = Design(design.id)
+            self.assertEqual(design.reconcile_lines(lines), (1, 1, 1))
+
+            lines = DesignLine.search([('quotation', '=', quote.id)])
+            self.assertEqual(len(lines), 3)
+            self.assertIn(kept, lines)
+            self.assertIn(changed, lines)
+            self.assertNotIn(removed, lines)
+            self.assertEqual(DesignLine(kept.id).manual_unit_price,
+                Decimal('3'))
+            self.assertEqual(DesignLine(changed.id).quantity, 4)
+
+    @with_transaction()
+    def test_property_price_ratio(self):
+        'Test memoised price ratios against the recursive ratios'
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        Design = pool.get('configurator.design')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Property.create([{
+                        'code': 'T',
+                        'name': 'Template',
+                        'type': 'group',
+                        'template': True,
+                        'quantity': '4',
+                        }])
+            parents = [template]
+            for depth in range(3):
+                parents = Property.create([{
+                            'code': 'G%s_%s_%s' % (depth, parent.id, i),
+                            'name': 'Group',
+                            'type': 'group',
+                            'parent': parent.id,
+                            'quantity': str(depth + i + 2),
+                            } for parent in parents for i in range(3)])
+            design, = Design.create([{
+                        'template': template.id,
+                        'quotation_uom': unit.id,
+                        'sale_uom': unit.id,
+                        }])
+
+            values = {}
+            with Transaction().set_context(prices=True):
+                expected = {p: p.get_ratio_for_prices(values, 1, design)
+                    for p in parents}
+                with patch.object(Property, 'evaluate',
+                        autospec=True, side_effect=Property.evaluate
+                        ) as evaluate:
+                    for prop in parents:
+                        self.assertAlmostEqual(
+                            prop.get_price_ratio(values, design),
+                            expected[prop])
+                    # one evaluation per property of the tree
+                    self.assertEqual(evaluate.call_count, 1 + 3 + 9 + 27)
+
+    @with_transaction()
+    def test_design_prices_cache(self):
+        'Test identical designs share their cached design lines'
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        Design = pool.get('configurator.design')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Property.create([{
+                        'code': 'T',
+                        'name': 'Template',
+                        'type': 'group',
+                        'template': True,
+                        }])
+            number, product = Property.create([{
+                        'code': 'N',
+                        'name': 'Number',
+                        'type': 'number',
+                        'user_input': True,
+                        'parent': template.id,
+                        }, {
+                        'code': 'P',
+                        'name': 'Product',
+                        'type': 'group',
+                        'parent': template.id,
+                        }])
+            designs = Design.create([{
+                        'template': template.id,
+                        'quotation_uom': unit.id,
+                        'sale_uom': unit.id,
+                        'attributes': [('create', [{
+                                        'property': number.id,
+                                        'number': value,
+                                        }])],
+                        'prices': [('create', [
+                                    {'quantity': 10}, {'quantity': 5}])],
+                        } for value in [2, 2, 3]])
+            first, second, other = designs
+            fingerprint = first.get_prices_fingerprint()
+            self.assertEqual(second.get_prices_fingerprint(), fingerprint)
+            self.assertNotEqual(other.get_prices_fingerprint(), fingerprint)
+            # the formulas can read any field of the design
+            changed = Design(second.id)
+            changed.manual_code = 'Manual'
+            self.assertNotEqual(changed.get_prices_fingerprint(), fingerprint)
+            self.assertIsNone(second.get_cached_price_lines(fingerprint))
+
+            prices = {}
+            for quote in first.prices:
+                line = product.create_design_line(
+                    quote.quantity, unit, Decimal('1.5'), quote)
+                line.property = product
+                line.qty_ratio = 1
+                line.debug_quantity = quote.quantity
+                prices[(product, quote)] = line
+            first.set_cached_price_lines(fingerprint, prices, ['P - Product'])
+
+            cached, product_codes = second.get_cached_price_lines(fingerprint)
+            self.assertEqual(product_codes, ['P - Product'])
+            self.assertEqual(
+                sorted((k[1].quantity, line.quantity, line.unit_price)
+                    for k, line in cached.items()),
+                [(5, 5, Decimal('1.5')), (10, 10, Decimal('1.5'))])
+            for (prop, quote), line in cached.items():
+                self.assertEqual(prop, product)
+                self.assertEqual(quote.design, second)
+                self.assertEqual(line.quotation, quote)
+
+            # the products not purchased are not priced
+            Template.create([{
+                        'name': 'Goods',
+                        'default_uom': unit.id,
+                        'purchasable': False,
+                        'products': [('create', [{}])],
+                        }])
+            self.assertIsNotNone(second.get_cached_price_lines(fingerprint))
+
+            # but the products no longer purchased were priced
+            purchased, = Template.create([{
+                        'name': 'Purchased',
+                        'default_uom': unit.id,
+                        'purchasable': True,
+                        'purchase_uom': unit.id,
+                        'products': [('create', [{}])],
+                        }])
+            first.set_cached_price_lines(fingerprint, prices, ['P - Product'])
+            self.assertIsNotNone(second.get_cached_price_lines(fingerprint))
+            Template.write([purchased], {'purchasable': False})
+            self.assertIsNone(second.get_cached_price_lines(fingerprint))
+            first.set_cached_price_lines(fingerprint, prices, ['P - Product'])
+
+            template.name = 'Modified'
+            template.save()
+            self.assertIsNone(second.get_cached_price_lines(fingerprint))
+
+    @with_transaction()
+    def test_property_bom_digest(self):
+        'Test BOMs with the same content have the same digest'
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Bom = pool.get('production.bom')
+        BomInput = pool.get('production.bom.input')
+        BomOutput = pool.get('production.bom.output')
+        Uom = pool.get('product.uom')
+
+        unit, = Uom.search([('name', '=', 'Unit')])
+        component, product = Template.create([{
+                    'name': name,
+                    'default_uom': unit.id,
+                    'products': [('create', [{}])],
+                    } for name in ['Component', 'Product']])
+        component, = component.products
+        product, = product.products
+
+        def bom(input_product, quantity):
+            return Bom(
+                name='BOM',
+                inputs=[BomInput(product=input_product, unit=unit,
+                        quantity=quantity)],
+                outputs=[BomOutput(product=product, unit=unit, quantity=1)])
+
+        saved = bom(component, 2)
+        saved.save()
+        digest = Property.get_bom_digest(Bom(saved.id))
+        self.assertIsNotNone(digest)
+        self.assertEqual(Property.get_bom_digest(bom(component, 2)), digest)
+        self.assertNotEqual(
+            Property.get_bom_digest(bom(component, 3)), digest)
+        self.assertIsNone(Property.get_bom_digest(
+                bom(Product(template=component.template), 2)))
+
+    @with_transaction()
+    def test_design_prefetch_products(self):
+        'Test the prefetch skips the codes that do not render'
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        Design = pool.get('configurator.design')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            base, = Template.create([{
+                        'name': 'Base',
+                        'code': 'CODE',
+                        'default_uom': unit.id,
+                        'configurator_template': True,
+                        'products': [('create', [{}])],
+                        }])
+            template, = Property.create([{
+                        'code': 'T',
+                        'name': 'Template',
+                        'type': 'group',
+                        'template': True,
+                        }])
+            failing, rendered = Property.create([{
+                        'code': 'B%s' % i,
+                        'name': 'BOM',
+                        'type': 'bom',
+                        'parent': template.id,
+                        'uom': unit.id,
+                        'quantity': '1',
+                        'bom_quantity': '1',
+                        'product_template': base.id,
+                        } for i in range(2)])
+            design, = Design.create([{
+                        'template': template.id,
+                        'quotation_uom': unit.id,
+                        'sale_uom': unit.id,
+                        }])
+
+            def get_property_code(prop, design, custom_locals):
+                if prop == failing:
+                    return 1 / 0
+                return 'CODE'
+
+            full = {}
+            with patch.object(Property, 'get_property_code', autospec=True,
+                    side_effect=get_property_code):
+                design.prefetch_products(full)
+
+            # the rendered code is reused and its products are prefetched
+            self.assertEqual(rendered.get_property_code(design, full), 'CODE')
+            with patch.object(Product, 'search') as search:
+                self.assertEqual(
+                    design.get_existing_products('CODE'), list(base.products))
+                search.assert_not_called()
+
+    def create_match_products(self):
+        '''
+        Create service products of two suppliers with width and color
+        attributes and return the suppliers, the attribute set and the
+        attributes.
+        '''
+        pool = Pool()
+        Party = pool.get('party.party')
+        Template = pool.get('product.template')
+        ProductSupplier = pool.get('purchase.product_supplier')
+        AttributeSet = pool.get('product.attribute.set')
+        Attribute = pool.get('product.attribute')
+        ProductAttribute = pool.get('product.product.attribute')
+        Uom = pool.get('product.uom')
+
+        unit, = Uom.search([('name', '=', 'Unit')])
+        supplier, other = Party.create([
+                {'name': 'Supplier'}, {'name': 'Other'}])
+        attribute_set, = AttributeSet.create([{'name': 'Set'}])
+        width, color, length = Attribute.create([{
+                    'name': name,
+                    'string': name.capitalize(),
+                    'type_': type_,
+                    'sets': [('add', [attribute_set.id])],
+                    } for name, type_ in [
+                    ('width', 'integer'),
+                    ('color', 'char'),
+                    ('length', 'integer'),
+                    ]])
+        for party, code, values in [
+                (supplier, 'S10R', {width: 10, color: 'red'}),
+                (supplier, 'S20R', {width: 20, color: 'red'}),
+                (supplier, 'S20B', {width: 20, color: 'blue'}),
+                (supplier, 'S20L', {width: 20, color: 'red', length: 5}),
+                (supplier, 'S30R', {width: 30, color: 'red'}),
+                (other, 'O40R', {width: 40, color: 'red'}),
+                ]:
+            template, = Template.create([{
+                        'name': code,
+                        'code': code,
+                        'type': 'service',
+                        'default_uom': unit.id,
+                        'attribute_set': attribute_set.id,
+                        'products': [('create', [{}])],
+                        }])
+            product, = template.products
+            ProductSupplier.create([{
+                        'template': template.id,
+                        'product': product.id,
+                        'party': party.id,
+                        }])
+            ProductAttribute.create([{
+                        'product': product.id,
+                        'attribute': attribute.id,
+                        'value_%s' % attribute.type_: value,
+                        } for attribute, value in values.items()])
+        return supplier, other, attribute_set, width, color
+
+    def search_match(self, supplier, criteria):
+        'Return the product matching criteria as the attribute searches did'
+        pool = Pool()
+        Product = pool.get('product.product')
+        ProductAttribute = pool.get('product.product.attribute')
+
+        products = [p.id for p in Product.search([
+                    ('type', '=', 'service'),
+                    ('product_suppliers.party', '=', supplier.id),
+                    ])]
+        attributes = None
+        for child, attribute, op, value in criteria:
+            if attributes is not None:
+                products = [a.product.id for a in attributes
+                    if a.product and a.product.id in products]
+            attributes = ProductAttribute.search([
+                    ('attribute_set', '=', child.attribute_set.id),
+                    ('attribute.id', '=', attribute.id),
+                    ('value_%s' % attribute.type_, op, value),
+                    ('product', 'in', products),
+                    ])
+        product = None
+        for attribute in attributes:
+            if len(attribute.product.attributes) <= len(criteria):
+                product = attribute.product
+        return product
+
+    @with_transaction()
+    def test_property_match_product(self):
+        'Test the match query against the attribute searches'
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        ProductAttribute = pool.get('product.product.attribute')
+
+        supplier, other, attribute_set, width, color = (
+            self.create_match_products())
+        child = SimpleNamespace(attribute_set=attribute_set)
+
+        def check():
+            for party, criteria, expected in [
+                    (supplier, [('=', 20), ('=', 'red')], 'S20R'),
+                    (supplier, [('=', 50), ('=', 'red')], None),
+                    (supplier, [('=', 40), ('=', 'red')], None),
+                    (other, [('=', 40), ('=', 'red')], 'O40R'),
+                    (supplier, [('!=', 20), ('=', 'red')], 'S30R'),
+                    (supplier, [('>=', 20), ('=', 'red')], 'S30R'),
+                    (supplier, [('<', 20), ('!=', 'blue')], 'S10R'),
+                    (supplier, [('=', 20)], None),
+                    ]:
+                criteria = [(child, attribute, op, value)
+                    for attribute, (op, value) in zip(
+                        [width, color], criteria)]
+                with patch.object(MatchIndex, 'supports',
+                        return_value=False):
+                    product = Property().match_product(party, criteria)
+                self.assertEqual(product, self.search_match(party, criteria))
+                if expected is None:
+                    self.assertIsNone(product)
+                else:
+                    self.assertEqual(product.code, expected)
+            return criteria
+
+        criteria = check()
+        self.assertIsNone(Property().match_product(None, criteria))
+        self.assertIsNone(Property().match_product(supplier, []))
+
+        # attributes without product are ignored
+        ProductAttribute.create([{
+                    'attribute': attribute.id,
+                    'value_%s' % attribute.type_: value,
+                    } for attribute, value in [
+                    (width, 20), (color, 'red'), (width, 30), (color, 'red'),
+                    ]])
+        check()
+
+    @with_transaction()
+    def test_property_match_index(self):
+        'Test the match index against the match query'
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        ProductAttribute = pool.get('product.product.attribute')
+
+        supplier, other, attribute_set, width, color = (
+            self.create_match_products())
+        child = SimpleNamespace(attribute_set=attribute_set)
+
+        for criteria in [
+                [('=', 20), ('=', 'red')],
+                [('=', 20), ('=', 'blue')],
+                [('=', 50), ('=', 'red')],
+                [('=', 40), ('=', 'red')],
+                [('=', 20)],
+                [('!=', 20), ('=', 'red')],
+                [('>=', 20), ('=', 'red')],
+                ]:
+            criteria = [(child, attribute, op, value)
+                for attribute, (op, value) in zip([width, color], criteria)]
+            with patch.object(MatchIndex, 'supports', return_value=False):
+                expected = Property().match_product(supplier, criteria)
+            supported = all(op == '=' for _, _, op, _ in criteria)
+            self.assertEqual(MatchIndex.supports(criteria), supported)
+            if supported:
+                index = Property.get_match_index(supplier)
+                product = index.match(criteria)
+                self.assertEqual(product, expected and expected.id)
+            self.assertEqual(
+                Property().match_product(supplier, criteria), expected)
+
+        # A supplier over the size limit is not loaded again
+        getint = config_.config.getint
+
+        def no_index(section, option, **kwargs):
+            if option == 'match_index_size':
+                return 0
+            return getint(section, option, **kwargs)
+
+        Property.clear_match_cache()
+        with patch.object(config_.config, 'getint', side_effect=no_index):
+            self.assertIsNone(Property.get_match_index(supplier))
+            with patch.object(ProductAttribute, 'search') as search:
+                self.assertIsNone(Property.get_match_index(supplier))
+                search.assert_not_called()
+
+    @with_transaction()
+    def test_design_function_order(self):
+        'Test design functions are evaluated after their references'
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        Design = pool.get('configurator.design')
+
+        template, = Property.create([{
+                    'code': 'T',
+                    'name': 'Template',
+                    'type': 'group',
+                    'template': True,
+                    }])
+        a, b, c, group = Property.create([{
+                    'code': code,
+                    'name': code,
+                    'type': type_,
+                    'quantity': quantity,
+                    'parent': template.id,
+                    } for code, type_, quantity in [
+                    ('A', 'function', 'B + 1'),
+                    ('B', 'function', '2'),
+                    ('C', 'function', 'A * B'),
+                    ('G', 'group', 'A'),
+                    ]])
+        functions = [a, b, c]
+        design = Design(template=template)
+
+        self.assertEqual(Property.get_expression_names(' '), set())
+        depends, _ = design.get_function_dependencies(functions, {}, [])
+        self.assertEqual(depends[c], {a, b})
+        self.assertEqual(
+            design.get_function_order(functions, [group], depends), [b, a, c])
+
+        getboolean = config_.config.getboolean
+
+        def prune(section, option, **kwargs):
+            if option == 'prune_functions':
+                return True
+            return getboolean(section, option, **kwargs)
+
+        with patch.object(config_.config, 'getboolean', side_effect=prune):
+            self.assertEqual(
+                design.get_function_order(functions, [group], depends),
+                [b, a])
+
+        b.quantity = 'C + 1'
+        b.save()
+        functions = Property.browse(functions)
+        depends, _ = design.get_function_dependencies(functions, {}, [])
+        with patch.object(config_.config, 'getboolean', side_effect=prune):
+            with self.assertRaises(UserError):
+                design.get_function_order(functions, [group], depends)
+        # without pruning the functions in a cycle keep the sequence order
+        with self.assertLogs(logger, 'WARNING'):
+            self.assertEqual(
+                design.get_function_order(functions, [group], depends),
+                [a, b, c])
+
+        # an earlier function referencing a function evaluated 2 times
+        d, f, e = Property.create([{
+                    'code': code,
+                    'name': code,
+                    'type': 'function',
+                    'quantity': quantity,
+                    'evaluate_2times': evaluate_2times,
+                    'parent': template.id,
+                    } for code, quantity, evaluate_2times in [
+                    ('D', 'E + 1', False),
+                    ('F', '3', False),
+                    ('E', "'F'", True),
+                    ]])
+        functions = [d, f, e]
+        depends, _ = design.get_function_dependencies(functions, {}, [])
+        self.assertEqual(depends[d], {e})
+        self.assertEqual(depends[e], {d, f})
+        with self.assertLogs(logger, 'WARNING'):
+            self.assertEqual(
+                design.get_function_order(functions, [group], depends),
+                [f, d, e])
+
+    @with_transaction()
+    def test_quotation_unit_prices(self):
+        'Test the batched unit prices against the prices of each line'
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        Design = pool.get('configurator.design')
+        Party = pool.get('party.party')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        ProductSupplier = pool.get('purchase.product_supplier')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            supplier, other = Party.create([
+                    {'name': 'Supplier'}, {'name': 'Other'}])
+            templates = Template.create([{
+                        'name': 'Component %s' % i,
+                        'default_uom': unit.id,
+                        'purchasable': True,
+                        'purchase_uom': unit.id,
+                        'products': [('create', [{}])],
+                        } for i in range(3)])
+            products = [t.products[0] for t in templates]
+            for party, factor in [(supplier, 1), (other, 2)]:
+                ProductSupplier.create([{
+                            'template': product.template.id,
+                            'product': product.id,
+                            'party': party.id,
+                            'prices': [('create', [{
+                                            'quantity': quantity,
+                                            'unit_price': Decimal(price)
+                                            * factor,
+                                            } for quantity, price in [
+                                            (0, '10'), (10, '8'),
+                                            (100, '5')]])],
+                            } for product in products])
+            template, = Property.create([{
+                        'code': 'T',
+                        'name': 'Template',
+                        'type': 'group',
+                        'template': True,
+                        }])
+            design, = Design.create([{
+                        'template': template.id,
+                        'quotation_uom': unit.id,
+                        'sale_uom': unit.id,
+                        'currency': company.currency.id,
+                        'prices': [('create', [
+                                    {'quantity': 10}, {'quantity': 100}])],
+                        }])
+
+            quantities = [1, 12.5, 150, -20]
+            parties = [supplier, other, None]
+            requests = [(quote, product, quantity, unit, party)
+                for quote in design.prices
+                for product in products
+                for quantity in quantities
+                for party in parties]
+
+            def unit_price(quote, product, quantity, uom, supplier):
+                context = quote._get_context_unit_price(product, uom, supplier)
+                with Transaction().set_context(context):
+                    price = Product.get_purchase_price(
+                        [product], abs(quantity or 0))[product.id]
+                if price:
+                    price = price.quantize(
+                        Decimal(1) / 10 ** price_digits[1])
+                return price
+
+            with patch.object(Product, 'get_purchase_price',
+                    wraps=Product.get_purchase_price) as get_purchase_price:
+                unit_prices = design.prices[0].get_unit_prices(requests)
+                # the quotes share the purchase context so there is one call
+                # per supplier and quantity with all the products
+                self.assertEqual(get_purchase_price.call_count,
+                    len(quantities) * len(parties))
+                for call in get_purchase_price.call_args_list:
+                    self.assertEqual(
+                        sorted(p.id for p in call.args[0]),
+                        sorted(p.id for p in products))
+            for request in requests:
+                self.assertEqual(
+                    unit_prices[request], unit_price(*request), request)
+
+    @with_transaction()
+    def test_design_requote_chunk(self):
+        'Test the re-quote state of the designs of a chunk'
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        Design = pool.get('configurator.design')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Property.create([{
+                        'code': 'T',
+                        'name': 'Template',
+                        'type': 'group',
+                        'template': True,
+                        }])
+            draft, failing, done = Design.create([{
+                        'template': template.id,
+                        'quotation_uom': unit.id,
+                        'sale_uom': unit.id,
+                        'prices': [('create', [{'quantity': 10}])],
+                        'requote_state': 'queued',
+                        } for _ in range(3)])
+            Design.write([done], {'state': 'done'})
+
+            def create_prices(designs):
+                if failing in designs:
+                    raise ValueError('Pricing failed')
+
+            # Run the chunk in the test transaction
+            with patch.object(Transaction, 'new_transaction',
+                    side_effect=lambda *a, **k: nullcontext()), \
+                    patch.object(Design, 'create_prices',
+                        side_effect=create_prices):
+                Design.requote_chunk([draft, failing, done])
+
+            draft, failing, done = Design.browse([draft, failing, done])
+            self.assertEqual(draft.requote_state, 'done')
+            self.assertIsNone(draft.requote_error)
+            self.assertEqual(failing.requote_state, 'failed')
+            self.assertIn('Pricing failed', failing.requote_error)
+            self.assertIsNone(done.requote_state)
+
+    @with_transaction()
+    def test_property_bom_reuse(self):
+        'Test the existing equivalent BOM of the product is linked'
+        pool = Pool()
+        Property = pool.get('configurator.property')
+        Design = pool.get('configurator.design')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Bom = pool.get('production.bom')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            base, = Template.create([{
+                        'name': 'Base',
+                        'default_uom': unit.id,
+                        'configurator_template': True,
+                        'products': [('create', [{}])],
+                        }])
+            template, = Property.create([{
+                        'code': 'T',
+                        'name': 'Template',
+                        'type': 'group',
+                        'template': True,
+                        }])
+            prop, = Property.create([{
+                        'code': 'B',
+                        'name': 'BOM',
+                        'type': 'bom',
+                        'parent': template.id,
+                        'uom': unit.id,
+                        'quantity': '1',
+                        'bom_quantity': '1',
+                        'product_template': base.id,
+                        }])
+            design, = Design.create([{
+                        'template': template.id,
+                        'quotation_uom': unit.id,
+                        'sale_uom': unit.id,
+                        }])
+            existing, = Template.create([{
+                        'name': 'Existing',
+                        'code': 'B (Id%s)' % design.id,
+                        'default_uom': unit.id,
+                        'products': [('create', [{}])],
+                        }])
+            product, = existing.products
+            equivalent, different = Bom.create([{
+                        'name': 'BOM %s' % quantity,
+                        'outputs': [('create', [{
+                                        'product': product.id,
+                                        'unit': unit.id,
+                                        'quantity': quantity,
+                                        }])],
+                        } for quantity in [1, 2]])
+            Product.write([product], {'boms': [('create', [{
+                                'bom': different.id,
+                                }, {
+                                'bom': equivalent.id,
+                                }])]})
+            count = Bom.search([], count=True)
+
+            def same(record, *args, **kwargs):
+                return record
+
+            def get_bom(update):
+                with patch.object(Property, 'update_product_values',
+                        create=True, side_effect=same), \
+                        patch.object(Property, 'update_variant_values',
+                            create=True, side_effect=same), \
+                        patch.object(Product, 'save') as save:
+                    with Transaction().set_context(update=update):
+                        res = prop.get_bom(design, {}, {}, {})
+                    save.assert_not_called()
+                return res
+
+            # the existing product is not written without update
+            res = get_bom(False)
+            self.assertEqual(res[prop], (equivalent, []))
+            product = Product(product.id)
+            self.assertEqual(
+                {b.bom for b in product.boms}, {different, equivalent})
+
+            res = get_bom(True)
+            bom, additional = res[prop]
+            self.assertEqual(bom, equivalent)
+            self.assertEqual(additional, [product])
+            design.save_objects(res)
+            self.assertEqual(Bom.search([], count=True), count)
+            product = Product(product.id)
+            self.assertEqual([b.bom for b in product.boms], [equivalent])
+            if 'phantom' in Product._fields:
+                self.assertTrue(product.phantom)
 
 del ModuleTestCase